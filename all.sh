@@ -1,21 +1,19 @@
 #!/bin/bash
 
-python init.py
+# Keep downloaded archives in the per-user cache next to the tool cache, so that re-running
+# the script downloads nothing that is already there.
+export BUILDER_DOWNLOAD_DIR="${BUILDER_DOWNLOAD_DIR:-${XDG_CACHE_HOME:-$HOME/.cache}/builder/downloads}"
 
-python tools/cmake.py
-python tools/ninja.py
+python init.py
 
-python libs/yaml_cpp.py
-python libs/cyrus_sasl.py
-python libs/date.py
-python libs/sqlpp11.py
+# Builds yaml_cpp, cyrus_sasl, date, sqlpp11, catch2 and boost in parallel in one process,
+# downloading CMake and Ninja if needed; sqlpp11 waits for date.
+# Use "python builder.py run --dry-run" to see the plan.
+python builder.py run
 
 # doesn't compile on some distributions due to horrible dependencies resolution
 # wait for 0.30 release where this problem should be solved
-# python libs/sqlpp11_mysql.py
-
-python libs/catch2.py
-python libs/boost.py
+# python builder.py run sqlpp11_mysql
 
 # doesn't compile with gcc 11 because of the bug: https://bugreports.qt.io/browse/QTBUG-90395
-# python libs/qt5base.py
+# python builder.py run qt5base
@@ -0,0 +1,103 @@
+#!/bin/python
+
+import io
+import os
+import tarfile
+import zipfile
+
+
+ARCHIVE_FORMATS = [".tar.gz", ".tar.bz2", ".tar.xz", ".zip"]
+
+
+CMAKE_LISTS = """cmake_minimum_required(VERSION 3.10)
+project({name} CXX)
+file(GLOB SOURCES src/*.cpp)
+add_library({name} SHARED ${{SOURCES}})
+target_include_directories({name} PRIVATE include)
+install(TARGETS {name} DESTINATION lib)
+install(DIRECTORY include/ DESTINATION include)
+"""
+
+CONFIGURE = """#!/bin/sh
+# minimal autotools-like configure: takes --prefix=, honours CC and CXX
+prefix=/usr/local
+for arg in "$@"; do
+    case "$arg" in
+        --prefix=*) prefix="${{arg#--prefix=}}" ;;
+    esac
+done
+srcdir=$(cd "$(dirname "$0")" && pwd)
+cat > Makefile <<MAKEFILE
+CXX = ${{CXX:-c++}}
+SOURCES = \\$(wildcard $srcdir/src/*.cpp)
+OBJECTS = \\$(notdir \\$(SOURCES:.cpp=.o))
+vpath %.cpp $srcdir/src
+
+all: lib{name}.so
+
+%.o: %.cpp
+\t\\$(CXX) -O2 -fPIC -I$srcdir/include -c \\$< -o \\$@
+
+lib{name}.so: \\$(OBJECTS)
+\t\\$(CXX) -shared -o \\$@ \\$^
+
+install: all
+\tmkdir -p $prefix/lib $prefix/include
+\tcp lib{name}.so $prefix/lib/
+\tcp -r $srcdir/include/. $prefix/include/
+MAKEFILE
+"""
+
+SOURCE = """#include "{name}.hpp"
+
+namespace {name} {{
+
+int function_{index}(int x)
+{{
+    int result = x;
+    for (int i = 0; i < {work}; ++i)
+        result = result * 31 + i;
+    return result;
+}}
+
+}} // namespace {name}
+"""
+
+
+# Return root directory name and dict from path to (content, mode) of a synthetic C++ library.
+# kind is "cmake" or "make"; files is the number of source files; work tunes the size of every
+# function; padding adds a data file of about the given size in bytes to make the archive bigger.
+def generate_project(name, kind, files=16, work=100, padding=0):
+    root = "{}-1.0".format(name)
+    contents = dict()
+    declarations = "".join("int function_{}(int x);\n".format(index) for index in range(files))
+    contents["include/{}.hpp".format(name)] = ("#pragma once\n\nnamespace {} {{\n\n{}\n}}\n".format(name, declarations), 0o644)
+    for index in range(files):
+        contents["src/{}_{}.cpp".format(name, index)] = (SOURCE.format(name=name, index=index, work=work), 0o644)
+    if kind == "cmake":
+        contents["CMakeLists.txt"] = (CMAKE_LISTS.format(name=name), 0o644)
+    else:
+        contents["configure"] = (CONFIGURE.format(name=name), 0o755)
+    if padding:
+        contents["doc/data.txt"] = ("".join("{:08x}\n".format(i * 2654435761 % 2 ** 32) for i in range(padding // 9)), 0o644)
+    return root, {os.path.join(root, path): value for path, value in contents.items()}
+
+
+def write_archive(filename, contents):
+    if filename.endswith(".zip"):
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as archive:
+            for path, (content, mode) in sorted(contents.items()):
+                info = zipfile.ZipInfo(path)
+                info.external_attr = (0o100000 | mode) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, content)
+        return
+
+    mode = {".tar.gz": "w:gz", ".tar.bz2": "w:bz2", ".tar.xz": "w:xz"}[filename[filename.index(".tar"):]]
+    with tarfile.open(filename, mode) as archive:
+        for path, (content, file_mode) in sorted(contents.items()):
+            data = content.encode()
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mode = file_mode
+            archive.addfile(info, io.BytesIO(data))
@@ -0,0 +1,173 @@
+#!/bin/python
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# add parent directory to path
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+import builder
+from projects import ARCHIVE_FORMATS, generate_project, write_archive
+from server import ArchiveServer
+
+
+# Run function repeat times in fresh working directories; return the median time in seconds.
+def measure(function, workdir, repeat):
+    times = []
+    for attempt in range(repeat):
+        rundir = os.path.join(workdir, "run-{}".format(attempt))
+        os.makedirs(rundir)
+        current_dir = os.getcwd()
+        os.chdir(rundir)
+        try:
+            start = time.monotonic()
+            function()
+            times.append(time.monotonic() - start)
+        finally:
+            os.chdir(current_dir)
+            shutil.rmtree(rundir)
+    return statistics.median(times)
+
+
+def make_builder(args, cache_dir=None):
+    bench_builder = builder.Builder(jobs=args.jobs, cache_dir=cache_dir)
+    bench_builder.cmake_binary = args.cmake
+    bench_builder.ninja_binary = args.ninja
+    return bench_builder
+
+
+# Add a recipe building every project (kind, archive URL, root directory) to builder.RECIPES; the first
+# one is a dependency of all the others, which are then built at the same time. Return the labels.
+def register_recipes(projects):
+    labels = []
+    for index, (kind, url, root) in enumerate(projects):
+        label = "bench_{}".format(index)
+
+        def build(self, version="1.0", kind=kind, root=root, label=label):
+            backend = self.build_cmake if kind == "cmake" else self.build_make
+            self.prefixes[label] = backend(source_dir=root, url=builder.recipe_url(label, version), label=label)
+
+        setattr(builder.Builder, "build_" + label, build)
+        builder.RECIPES[label] = builder.Recipe("build_" + label, label, labels[:1], url)
+        labels.append(label)
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of Builder download, extraction and build code paths.")
+    parser.add_argument("--files", type=int, default=32, help="source files per synthetic project")
+    parser.add_argument("--work", type=int, default=200, help="loop length in every generated function")
+    parser.add_argument("--padding", type=int, default=16 * 1024 * 1024, help="bytes of data added to archives")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the median is reported")
+    parser.add_argument("--recipes", type=int, default=4, help="synthetic recipes built by build_recipes")
+    parser.add_argument("-j", "--jobs", type=int, default=builder.available_cpus())
+    parser.add_argument("--cmake", default=shutil.which("cmake"))
+    parser.add_argument("--ninja", default=shutil.which("ninja"))
+    parser.add_argument("--only", nargs="*", help="run only benchmarks with names starting with these prefixes")
+    parser.add_argument("--output", help="write results to JSON file, e.g. to record a baseline")
+    parser.add_argument("--baseline", help="compare results with JSON file written by --output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="builder-bench-")
+    served = os.path.join(workdir, "served")
+    os.makedirs(served)
+
+    archives = dict()
+    for kind in ("cmake", "make"):
+        root, contents = generate_project("bench_{}".format(kind), kind, args.files, args.work, args.padding)
+        for archive_format in ARCHIVE_FORMATS:
+            filename = "{}{}".format(root, archive_format)
+            write_archive(os.path.join(served, filename), contents)
+            archives[(kind, archive_format)] = (filename, root, len(contents))
+
+    # recipes alternate between CMake and make, without CMake and Ninja all of them use make
+    server = ArchiveServer(served)
+    projects = []
+    recipes_size = recipes_files = 0
+    for index in range(args.recipes):
+        kind = "cmake" if index % 2 == 0 and args.cmake and args.ninja else "make"
+        root, contents = generate_project("bench_recipe_{}".format(index), kind, args.files, args.work, args.padding)
+        filename = "{}.tar.gz".format(root)
+        write_archive(os.path.join(served, filename), contents)
+        projects.append((kind, server.url(filename), root))
+        recipes_size += os.path.getsize(os.path.join(served, filename))
+        recipes_files += len(contents)
+    labels = register_recipes(projects)
+    warm_cache = os.path.join(workdir, "warm-cache")
+
+    benchmarks = []
+    for archive_format in ARCHIVE_FORMATS:
+        filename, root, files = archives[("make", archive_format)]
+        size = os.path.getsize(os.path.join(served, filename))
+        benchmarks.append(("download_and_extract/stream/" + archive_format, size, files,
+                           lambda url: builder.download_and_extract_archive(url=url, label="bench")))
+        benchmarks.append(("download_and_extract/download_dir/" + archive_format, size, files,
+                           lambda url: builder.download_and_extract_archive(url=url, label="bench",
+                                                                            download_dir=os.path.abspath("downloads"))))
+        if archive_format != ".zip" or shutil.which("7z"):
+            benchmarks.append(("download_and_extract/no_stream/" + archive_format, size, files,
+                               lambda url: builder.download_and_extract_archive(url=url, label="bench", stream=False)))
+    if args.cmake and args.ninja:
+        filename, root, files = archives[("cmake", ".tar.gz")]
+        benchmarks.append(("build_cmake", os.path.getsize(os.path.join(served, filename)), files,
+                           lambda url, root=root: make_builder(args).build_cmake(source_dir=root, url=url, label="bench")))
+    else:
+        print("CMake or Ninja not found, skipping build_cmake")
+    filename, root, files = archives[("make", ".tar.gz")]
+    benchmarks.append(("build_make", os.path.getsize(os.path.join(served, filename)), files,
+                       lambda url, root=root: make_builder(args).build_make(source_dir=root, url=url, label="bench")))
+    if labels:
+        # scheduling, prefetching and the build cache; the warm pass only restores prefixes from the cache
+        benchmarks.append(("build_recipes/cold", recipes_size, recipes_files,
+                           lambda url: make_builder(args, os.path.abspath("cache")).build_recipes(labels)))
+        benchmarks.append(("build_recipes/warm_cache", recipes_size, recipes_files,
+                           lambda url: make_builder(args, warm_cache).build_recipes(labels)))
+
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    results = dict()
+    with server:
+        for name, size, files, function in benchmarks:
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            if name.startswith("build_recipes"):
+                # the recipes know the URLs of their archives
+                url = None
+            elif name.startswith("build"):
+                url = server.url(archives[(name.split("_")[1], ".tar.gz")][0])
+            else:
+                url = server.url(archives[("make", name.rsplit("/", 1)[1])][0])
+            if name == "build_recipes/warm_cache":
+                # an untimed build fills the cache
+                measure(lambda: function(url), workdir, 1)
+            seconds = measure(lambda: function(url), workdir, args.repeat)
+            results[name] = {"seconds": seconds, "mb_per_second": size / seconds / 1e6, "files_per_second": files / seconds}
+
+            line = "{:45} {:8.3f}s {:8.1f} MB/s {:8.0f} files/s".format(
+                name, seconds, results[name]["mb_per_second"], results[name]["files_per_second"])
+            if name in baseline:
+                line += "  {:+6.1f}% vs baseline".format((seconds / baseline[name]["seconds"] - 1) * 100)
+            print(line, file=sys.stderr)
+
+    shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"parameters": {"files": args.files, "work": args.work, "padding": args.padding,
+                                      "jobs": args.jobs, "repeat": args.repeat, "recipes": args.recipes},
+                       "results": results}, output_file, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/bin/python
+
+import http.server
+import os
+import threading
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler that also serves "Range: bytes=N-" requests, used to test resumed downloads."""
+
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if range_header is None or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start = int(range_header.strip().split("=")[1].split("-")[0])
+        if start >= size:
+            self.send_error(416)
+            return None
+
+        archive_file = open(path, "rb")
+        archive_file.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, size - 1, size))
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        return archive_file
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ArchiveServer:
+    """HTTP server serving files of the directory on a free localhost port in a background thread."""
+
+    def __init__(self, directory):
+        handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=directory, **kwargs)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, filename):
+        return "http://127.0.0.1:{}/{}".format(self.server.server_address[1], filename)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,10 +1,30 @@
 #!/bin/python
 
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import filecmp
+import functools
+import hashlib
+import inspect
+import json
 import os
-import pickle
-import requests
+import re
+import shlex
+import shutil
+import signal
+import state
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+import weakref
+import zipfile
 
 
 def get_platform():
@@ -21,70 +41,1300 @@ def get_platform():
     return platforms[sys.platform]
 
 
-def execute_command(cmd):
-    ret = subprocess.call(cmd, shell=True)
+# Per-thread timing state: events list the phases are recorded to, recipe label and current phase event
+tracing = threading.local()
+
+# Per-thread execution state set by run_recipe: recipe label, log file the output of the commands goes to,
+# dict from phase name to its timeout in seconds and (monotonic time, phase, timeout) of the nearest deadline
+execution = threading.local()
+
+# Recipe label -> processes being run for it, and labels of the recipes whose commands are killed
+running_processes = collections.defaultdict(set)
+cancelled_recipes = set()
+processes_lock = threading.Lock()
+
+
+# Timeout of a phase in seconds or None; a phase doing several things at once ("compile+install")
+# is limited by the sum of the timeouts of its parts unless it has a timeout of its own
+def phase_timeout(timeouts, name):
+    if name in timeouts:
+        return timeouts[name]
+    parts = [timeouts[part] for part in name.split("+") if part in timeouts]
+    return sum(parts) if parts else None
+
+
+@contextlib.contextmanager
+def phase(name):
+    deadline = getattr(execution, "deadline", None)
+    timeout = phase_timeout(getattr(execution, "timeouts", None) or dict(), name)
+    if timeout is not None and (deadline is None or time.monotonic() + timeout < deadline[0]):
+        execution.deadline = (time.monotonic() + timeout, name, timeout)
+
+    try:
+        events = getattr(tracing, "events", None)
+        if events is None:
+            yield
+            return
+
+        event = {"recipe": tracing.recipe, "phase": name, "start": time.time(),
+                 "thread": threading.get_ident(), "cpu_time": 0.0, "max_rss": 0}
+        parent = getattr(tracing, "event", None)
+        tracing.event = event
+        try:
+            yield
+        finally:
+            event["duration"] = time.time() - event["start"]
+            tracing.event = parent
+            if parent is not None:
+                parent["cpu_time"] += event["cpu_time"]
+                parent["max_rss"] = max(parent["max_rss"], event["max_rss"])
+            events.append(event)
+    finally:
+        execution.deadline = deadline
+
+
+def kill_process(process):
+    try:
+        if os.name == "posix":
+            # the command runs in its own session, so make, compilers and everything else it started die too
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+# Kill the commands of the recipes and make them fail before starting any other
+def cancel_recipes(labels):
+    with processes_lock:
+        cancelled_recipes.update(labels)
+        for label in labels:
+            for process in running_processes[label]:
+                kill_process(process)
+
+
+# Split parameters the way a POSIX shell would, except that on Windows backslashes are kept,
+# they separate the parts of paths there; quotes still group words.
+def split_params(params):
+    lexer = shlex.shlex(params, posix=True)
+    lexer.whitespace_split = True
+    if os.name == "nt":
+        lexer.escape = ""
+    return list(lexer)
+
+
+# cmd is a list of arguments or a string that is split into arguments by split_params;
+# no shell is run either way. Within run_recipe the output goes to the log of the recipe, and the
+# command is killed when the timeout of the current phase expires or the recipe is cancelled.
+def execute_command(cmd, cwd=None, env=None, pass_fds=()):
+    args = split_params(cmd) if isinstance(cmd, str) else [str(arg) for arg in cmd]
+    command_line = " ".join(shlex.quote(arg) for arg in args)
+    recipe = getattr(execution, "recipe", None)
+    log = getattr(execution, "log", None)
+    deadline = getattr(execution, "deadline", None)
+
+    log_file = None
+    if log is not None:
+        log_file = open(log, "a")
+        log_file.write("$ {}{}\n".format(command_line, "" if cwd is None else " (in {})".format(cwd)))
+        log_file.flush()
+    try:
+        with processes_lock:
+            if recipe in cancelled_recipes:
+                raise RuntimeError('Cancelled before executing "{}"'.format(command_line))
+            process = subprocess.Popen(args, cwd=cwd, env=env, pass_fds=pass_fds,
+                                       stdout=log_file, stderr=None if log_file is None else subprocess.STDOUT,
+                                       start_new_session=os.name == "posix")
+            running_processes[recipe].add(process)
+    finally:
+        if log_file is not None:
+            log_file.close()
+
+    timed_out = threading.Event()
+    timer = None
+    if deadline is not None:
+        def expire():
+            timed_out.set()
+            kill_process(process)
+        timer = threading.Timer(max(deadline[0] - time.monotonic(), 0), expire)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        if hasattr(os, "wait4"):
+            # unlike Popen.wait, wait4 returns resource usage of the command and the processes it waited for
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = ret = os.waitstatus_to_exitcode(status)
+            event = getattr(tracing, "event", None)
+            if event is not None:
+                event["cpu_time"] += usage.ru_utime + usage.ru_stime
+                max_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+                event["max_rss"] = max(event["max_rss"], max_rss)
+        else:
+            ret = process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        with processes_lock:
+            running_processes[recipe].discard(process)
+
+    if timed_out.is_set():
+        raise RuntimeError('Phase {} timed out after {}s while executing "{}"'.format(deadline[1], deadline[2], command_line))
+    if recipe in cancelled_recipes:
+        raise RuntimeError('Cancelled while executing "{}"'.format(command_line))
     if ret != 0:
-        raise RuntimeError('Exit code {} while executing "{}"'.format(ret, cmd))
+        if log is not None:
+            raise RuntimeError('Exit code {} while executing "{}", see {}'.format(ret, command_line, log))
+        raise RuntimeError('Exit code {} while executing "{}"'.format(ret, command_line))
+
+
+# Last lines of a log file, to show why a command failed
+def log_tail(filename, lines=20):
+    if not os.path.isfile(filename):
+        return ""
+    with open(filename, errors="replace") as log_file:
+        return "".join(collections.deque(log_file, lines))
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class JobServer:
+    """
+    GNU make jobserver shared by the make processes of concurrently built recipes.
+
+    Every make process has one implicit job slot and takes the others from the pipe. Other build
+    tools (Ninja, b2) take the job slots they use from the pipe too, see acquire.
+    """
+
+    def __init__(self, jobs):
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, b"+" * max(jobs - 1, 0))
+        self.withhold_fd = None
+        self.acquire_lock = threading.Lock()
+
+    def makeflags(self):
+        return "-j --jobserver-auth={},{}".format(self.read_fd, self.write_fd)
+
+    # Take a free job slot away from make processes; return whether there was one
+    def withhold(self):
+        if self.withhold_fd is None:
+            # reopening the pipe gives a separate non-blocking file description, so make's reads stay blocking
+            self.withhold_fd = os.open("/proc/self/fd/{}".format(self.read_fd), os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            return len(os.read(self.withhold_fd, 1)) == 1
+        except BlockingIOError:
+            return False
+
+    # Give withheld or acquired job slots back
+    def release(self, slots=1):
+        os.write(self.write_fd, b"+" * slots)
+
+    # Take job slots for a build tool that is not make, waiting for make processes to give them back;
+    # one tool at a time, so that two tools holding a part of what they need do not wait for each other
+    def acquire(self, slots):
+        with self.acquire_lock:
+            taken = 0
+            while taken < slots:
+                taken += len(os.read(self.read_fd, slots - taken))
+
+    def close(self):
+        if self.withhold_fd is not None:
+            os.close(self.withhold_fd)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+# "8G", "512M" or a number of bytes -> number of bytes
+def parse_size(text):
+    text = str(text).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# /proc/meminfo as dict from field name to number of bytes
+def memory_info():
+    info = dict()
+    with open("/proc/meminfo") as meminfo:
+        for line in meminfo:
+            name, value = line.split(":", 1)
+            value = value.split()
+            info[name] = int(value[0]) * (1024 if len(value) > 1 else 1)
+    return info
+
+
+# Return total RSS of the descendants of the process and their (start time, pid) pairs
+# that have no children themselves, i.e. the compilers and linkers running right now
+def descendant_processes(pid):
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    processes = dict()
+    children = collections.defaultdict(list)
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(name)) as stat_file:
+                # the command name may contain spaces and parentheses, so the fields are counted after it
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        processes[int(name)] = (int(fields[19]), int(fields[21]) * page_size)
+        children[int(fields[1])].append(int(name))
+
+    rss = 0
+    leaves = []
+    stack = list(children[pid])
+    while stack:
+        child = stack.pop()
+        if child not in processes:
+            continue
+        rss += processes[child][1]
+        if children[child]:
+            stack.extend(children[child])
+        else:
+            leaves.append((processes[child][0], child))
+    return rss, leaves
+
 
+class ResourceMonitor:
+    """
+    Background thread keeping the builds under a memory ceiling, Linux only.
+
+    Under memory pressure, i.e. when the RSS of all the build processes exceeds memory_limit or less
+    than a tenth of the system memory is available, it takes job slots away from the make jobserver,
+    and if that is not enough, stops (SIGSTOP) the most recently started compilers and linkers,
+    keeping at least one running. Stopped processes are continued one by one as soon as the pressure
+    goes away, and whenever no other build process is left running, since their memory is not freed
+    while they wait. Job slots are given back one by one once memory use is well below the limit. build_recipes does not start new recipes while the monitor is
+    throttling or the load average exceeds the number of CPUs by half.
+    """
 
-def check_prefix_dif(prefix_dir, source_dir):
+    def __init__(self, memory_limit=None, jobserver=None, interval=1.0):
+        self.memory_limit = memory_limit
+        self.jobserver = jobserver
+        self.interval = interval
+        self.withheld = 0
+        self.stopped = []
+        self.pressure = False
+        self.overloaded = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def throttling(self):
+        return self.pressure or self.overloaded or bool(self.stopped) or self.withheld > 0
+
+    def sample(self):
+        info = memory_info()
+        rss, leaves = descendant_processes(os.getpid())
+        reserve = info["MemTotal"] // 10
+        available = info.get("MemAvailable", info["MemFree"])
+        pressure = available < reserve or (self.memory_limit is not None and rss > self.memory_limit)
+        # hysteresis, so the job count doesn't flap around the limit
+        relaxed = available > 2 * reserve and (self.memory_limit is None or rss < 0.8 * self.memory_limit)
+        return pressure, relaxed, leaves
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                pressure, relaxed, leaves = self.sample()
+                self.overloaded = os.getloadavg()[0] > 1.5 * available_cpus()
+            except OSError:
+                continue
+            self.pressure = pressure
+            running = [leaf for leaf in leaves if leaf not in self.stopped]
+            if self.stopped and not running:
+                # only stopped processes are left, so nothing else would free memory for them
+                self.resume()
+            elif pressure:
+                self.throttle(leaves)
+            elif self.stopped:
+                self.resume()
+            elif relaxed:
+                self.relax()
+
+    def throttle(self, leaves):
+        if self.jobserver is not None and self.jobserver.withhold():
+            self.withheld += 1
+            return
+        running = sorted(leaf for leaf in leaves if leaf not in self.stopped)
+        if len(running) > 1:
+            start_time, pid = running[-1]
+            try:
+                os.kill(pid, signal.SIGSTOP)
+            except ProcessLookupError:
+                return
+            print("Memory pressure, pausing process {}".format(pid))
+            self.stopped.append((start_time, pid))
+
+    def resume(self):
+        start_time, pid = self.stopped.pop(0)
+        try:
+            os.kill(pid, signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+
+    def relax(self):
+        if self.withheld > 0:
+            self.jobserver.release()
+            self.withheld -= 1
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        for start_time, pid in self.stopped:
+            try:
+                os.kill(pid, signal.SIGCONT)
+            except ProcessLookupError:
+                pass
+        self.stopped = []
+        for _ in range(self.withheld):
+            self.jobserver.release()
+        self.withheld = 0
+
+
+def check_prefix_dif(prefix_dir, source_dir, reuse=False, name="prefix"):
     if prefix_dir is None:
-        prefix_dir = os.path.join(os.path.abspath(source_dir), "prefix")
+        prefix_dir = os.path.join(os.path.abspath(source_dir), name)
     if os.path.isdir(prefix_dir):
+        if reuse:
+            return prefix_dir
         raise RuntimeError("Prefix directory {} already exists".format(prefix_dir))
     os.mkdir(prefix_dir)
     return prefix_dir
 
 
-def check_build_dir(build_dir, source_dir):
+def check_build_dir(build_dir, source_dir, reuse=False, name="build"):
     if build_dir is None:
-        build_dir = os.path.join(os.path.abspath(source_dir), "build")
+        build_dir = os.path.join(os.path.abspath(source_dir), name)
     if os.path.isdir(build_dir):
+        if reuse:
+            return build_dir
         raise RuntimeError("Build directory {} already exists".format(build_dir))
     os.mkdir(build_dir)
     return build_dir
 
 
-def download_and_extract_archive(url, label="temp"):
+compiler_identities = dict()
+
+
+def compiler_identity(compiler):
+    if compiler not in compiler_identities:
+        try:
+            output = subprocess.run([compiler, "--version"], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, universal_newlines=True).stdout
+            version = output.strip().splitlines()[0] if output.strip() else ""
+        except OSError:
+            version = ""
+        compiler_identities[compiler] = "{}: {}".format(os.path.basename(compiler), version)
+    return compiler_identities[compiler]
+
+
+native_targets = dict()
+
+
+# What -march=native resolves to on this machine: the CPU and the enabled target options as GCC reports
+# them, or the target CPU and features clang passes to its frontend; "" if the compiler tells neither
+def native_target(compiler):
+    if compiler not in native_targets:
+        target = []
+        try:
+            output = subprocess.run([compiler, "-march=native", "-Q", "--help=target"], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+            for line in output.splitlines():
+                words = line.split()
+                if len(words) == 2 and words[0] in ("-march=", "-mtune="):
+                    target.append(words[0] + words[1])
+                elif len(words) == 2 and words[1] == "[enabled]":
+                    target.append(words[0])
+            if not target:
+                output = subprocess.run([compiler, "-march=native", "-###", "-E", "-x", "c", os.devnull],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                        universal_newlines=True).stderr
+                words = re.findall(r'"([^"]*)"', output)
+                target = ["{} {}".format(option, value) for option, value in zip(words, words[1:])
+                          if option in ("-target-cpu", "-target-feature")]
+        except OSError:
+            pass
+        native_targets[compiler] = " ".join(target)
+    return native_targets[compiler]
+
+
+# Translate glob pattern of archive member paths to regex: "*" and "?" do not match "/",
+# "**/" matches any number of directories, and "dir/**" matches dir itself and everything below it
+def member_pattern(pattern):
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "(/.*)?"
+            i += 3
+        elif pattern.startswith("**/", i):
+            regex += "(.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex)
+
+
+# Return predicate selecting archive members to extract, or None to extract everything.
+# A member is extracted if it matches any of include patterns (if there are any) and is not excluded.
+# Exclude patterns work like .gitignore: the last matching one wins, and "!pattern" brings members back.
+def member_filter(include=None, exclude=None):
+    if not include and not exclude:
+        return None
+    include = [member_pattern(pattern) for pattern in include or ()]
+    exclude = [(pattern.startswith("!"), member_pattern(pattern.lstrip("!"))) for pattern in exclude or ()]
+
+    def selected(name):
+        name = name.rstrip("/")
+        if name.startswith("./"):
+            name = name[2:]
+        if include and not any(pattern.fullmatch(name) for pattern in include):
+            return False
+        extract = True
+        for negated, pattern in exclude:
+            if pattern.fullmatch(name):
+                extract = negated
+        return extract
+
+    return selected
+
+
+def extract_tar(fileobj, path=".", mode="r|*", selected=None):
+    # "r|*" reads the archive sequentially, so fileobj may be a non-seekable stream
+    with tarfile.open(fileobj=fileobj, mode=mode) as archive:
+        # parent directories of selected members are created even if they are not selected themselves
+        members = archive if selected is None else (member for member in archive if selected(member.name))
+        if hasattr(tarfile, "tar_filter"):
+            archive.extractall(path, members, filter="tar")
+        else:
+            archive.extractall(path, members)
+
+
+def extract_zip(filename, selected=None, path="."):
+    with zipfile.ZipFile(filename) as archive:
+        for info in archive.infolist():
+            if selected is not None and not selected(info.filename):
+                continue
+            extracted = archive.extract(info, path)
+            # zipfile does not restore permissions, so executables would lose their x bit
+            mode = (info.external_attr >> 16) & 0o777
+            if mode and not info.is_dir():
+                os.chmod(extracted, mode)
+
+
+sessions = dict()
+sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with sessions_lock:
+        if host not in sessions:
+            # requests takes a noticeable part of the startup time, so it's imported only when needed
+            import requests
+            import requests.adapters
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[host] = session
+        return sessions[host]
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as archive_file:
+        for chunk in iter(lambda: archive_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashingReader:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        # tarfile stops at the end-of-archive marker, the padding after it is hashed too
+        for chunk in iter(lambda: self.read(1024 * 1024), b""):
+            pass
+        return self.digest.hexdigest()
+
+
+def check_sha256(url, actual, expected):
+    if expected is not None and actual != expected.lower():
+        raise RuntimeError("SHA256 mismatch for {}: expected {}, got {}".format(url, expected, actual))
+
+
+# Download url into filename, resuming from filename.part if the server supports range requests.
+# An existing file is reused without network access if it matches sha256 (or sha256 is None).
+# filename.lock keeps other threads and processes (builders sharing the download cache) from
+# writing the same part file; they wait and then reuse the downloaded file.
+def download_archive(url, filename, sha256=None):
+    with file_lock(filename + ".lock"):
+        if os.path.isfile(filename):
+            if sha256 is None or file_sha256(filename) == sha256.lower():
+                print("Using downloaded {}".format(filename))
+                return
+            os.remove(filename)
+
+        part = filename + ".part"
+        while True:
+            offset = os.path.getsize(part) if os.path.isfile(part) else 0
+            headers = {"Accept-Encoding": "identity"}
+            if offset:
+                headers["Range"] = "bytes={}-".format(offset)
+
+            print("Downloading {}{}...".format(url, " from byte {}".format(offset) if offset else ""))
+            with get_session(url).get(url, headers=headers, allow_redirects=True, stream=True) as response:
+                if response.status_code == 416:
+                    # the part file is already complete or garbage, start over
+                    os.remove(part)
+                    continue
+                response.raise_for_status()
+                if response.status_code != 206:
+                    offset = 0
+                with open(part, "ab" if offset else "wb") as archive_file:
+                    for chunk in response.iter_content(1024 * 1024):
+                        archive_file.write(chunk)
+            break
+
+        actual = file_sha256(part)
+        if sha256 is not None and actual != sha256.lower():
+            os.remove(part)
+        check_sha256(url, actual, sha256)
+        os.replace(part, filename)
+        print("Done!")
+
+
+def cached_archive_name(download_dir, url):
+    url_hash = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return os.path.join(download_dir, "{}-{}".format(url_hash, os.path.basename(url)))
+
+
+# include and exclude are glob patterns of archive member paths, see member_filter;
+# the archive is extracted into directory
+def download_and_extract_archive(url, label="temp", stream=True, download_dir=None, sha256=None,
+                                 include=None, exclude=None, directory="."):
     if url.endswith(".tar.gz"):
         archive_format = ".tar.gz"
     elif url.endswith(".tar.bz2"):
         archive_format = ".tar.bz2"
     elif url.endswith(".tar.xz"):
-        archive_format = ".tar.bz2"
+        archive_format = ".tar.xz"
     elif url.endswith(".zip"):
         archive_format = ".zip"
     else:
         raise RuntimeError("Unknown archive type on URL {}".format(url))
 
     archive_name = label + archive_format
+    selected = member_filter(include, exclude)
+
+    if download_dir is not None:
+        if not os.path.isdir(download_dir):
+            os.makedirs(download_dir, exist_ok=True)
+        archive_name = cached_archive_name(download_dir, url)
+        with phase("download"):
+            download_archive(url, archive_name, sha256)
+
+        print("Extracting {}...".format(archive_name))
+        with phase("extract"):
+            if archive_format == ".zip":
+                extract_zip(archive_name, selected, directory)
+            else:
+                with open(archive_name, "rb") as archive_file:
+                    extract_tar(archive_file, directory, selected=selected)
+        print("Done!")
+        return
+
+    if stream:
+        print("Downloading and extracting {} from {}...".format(label, url))
+        # extraction overlaps with download, so both are recorded as one phase
+        with phase("download+extract"):
+            with get_session(url).get(url, allow_redirects=True, stream=True) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                reader = HashingReader(response.raw)
+                if archive_format == ".zip":
+                    # zip central directory is at the end of the archive, so it can't be extracted on the fly
+                    with open(archive_name, "wb") as archive_file:
+                        shutil.copyfileobj(reader, archive_file, 1024 * 1024)
+                    check_sha256(url, reader.hexdigest(), sha256)
+                    extract_zip(archive_name, selected, directory)
+                    os.remove(archive_name)
+                else:
+                    extract_tar(reader, directory, selected=selected)
+                    check_sha256(url, reader.hexdigest(), sha256)
+        print("Done!")
+        return
+
     print("Downloading {} from {}...".format(label, url))
-    open(archive_name, "wb").write(requests.get(url, allow_redirects=True).content)
+    with phase("download"):
+        open(archive_name, "wb").write(get_session(url).get(url, allow_redirects=True).content)
+        check_sha256(url, file_sha256(archive_name), sha256)
     print("Done!")
 
     print("Extracting {}...".format(archive_name))
-    if archive_format == ".zip":
-        execute_command("7z x {}".format(archive_name))
-    elif archive_format == ".tar.gz" or archive_format == ".tar.bz2" or archive_format == ".tar.xz":
-        execute_command("tar -xf {}".format(archive_name))
-    else:
-        assert False
+    with phase("extract"):
+        if selected is not None:
+            # 7z and tar wildcards differ from member_filter patterns, so filtered archives are extracted here
+            if archive_format == ".zip":
+                extract_zip(archive_name, selected, directory)
+            else:
+                with open(archive_name, "rb") as archive_file:
+                    extract_tar(archive_file, directory, selected=selected)
+        elif archive_format == ".zip":
+            execute_command(["7z", "x", "-o{}".format(directory), archive_name])
+        elif archive_format == ".tar.gz" or archive_format == ".tar.bz2" or archive_format == ".tar.xz":
+            execute_command(["tar", "-xf", archive_name, "-C", directory])
+        else:
+            assert False
     print("Done!")
 
 
+# Return the contents of a text file, or None if it is a binary file (with a NUL byte in its first 8 KiB)
+def read_text_file(path):
+    with open(path, "rb") as text_file:
+        head = text_file.read(8192)
+        if b"\0" in head:
+            return None
+        return head + text_file.read()
+
+
+# qmake has the prefix compiled in; qt.conf next to it overrides it with a relative path.
+# It is unlinked first, the file may be a hardlink to another prefix
+def write_qt_conf(prefix_dir):
+    if not os.path.isfile(os.path.join(prefix_dir, "bin", "qmake")):
+        return
+    if os.path.lexists(os.path.join(prefix_dir, "bin", "qt.conf")):
+        os.remove(os.path.join(prefix_dir, "bin", "qt.conf"))
+    with open(os.path.join(prefix_dir, "bin", "qt.conf"), "w") as qt_conf:
+        qt_conf.write("[Paths]\nPrefix=..\n")
+
+
+# Replace absolute paths in symlinks and text files of the prefix: CMake configs, pkg-config .pc and
+# libtool .la files, Qt .prl and .pri files, scripts. Binary files are left as is.
+def relocate_prefix(prefix_dir, replacements):
+    replacements = [(old.encode(), new.encode()) for old, new in replacements if old and old != new]
+    for root, dirs, files in os.walk(prefix_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                target = os.readlink(path)
+                relocated = target
+                for old, new in replacements:
+                    relocated = relocated.replace(old.decode(), new.decode())
+                if relocated != target:
+                    os.remove(path)
+                    os.symlink(relocated, path)
+                continue
+            if name not in files:
+                continue
+
+            data = read_text_file(path)
+            if data is None:
+                continue
+            relocated = data
+            for old, new in replacements:
+                relocated = relocated.replace(old, new)
+            if relocated != data:
+                # replaced rather than rewritten, the file may be a hardlink to another prefix
+                with open(path + ".tmp", "wb") as relocated_file:
+                    relocated_file.write(relocated)
+                shutil.copymode(path, path + ".tmp")
+                os.replace(path + ".tmp", path)
+
+    write_qt_conf(prefix_dir)
+
+
+# Return "executable" (executables and shared libraries), "object" (relocatable object), "archive" (static
+# library) or None if the file is not an ELF binary strip can handle
+def binary_kind(path):
+    with open(path, "rb") as binary_file:
+        header = binary_file.read(18)
+    if header.startswith(b"!<arch>\n"):
+        return "archive"
+    if not header.startswith(b"\x7fELF") or len(header) < 18:
+        return None
+    e_type = int.from_bytes(header[16:18], "little" if header[5] == 1 else "big")
+    return "object" if e_type == 1 else "executable"
+
+
+# Remove files and directories of the prefix not selected by exclude patterns (see member_filter), then the
+# directories left empty
+def exclude_from_prefix(prefix_dir, exclude):
+    selected = member_filter(exclude=exclude)
+    for root, dirs, files in os.walk(prefix_dir):
+        for name in list(dirs) + files:
+            path = os.path.join(root, name)
+            if selected(os.path.relpath(path, prefix_dir).replace(os.sep, "/")):
+                continue
+            if name in dirs and not os.path.islink(path):
+                shutil.rmtree(path)
+                dirs.remove(name)
+            else:
+                os.remove(path)
+    for root, dirs, files in os.walk(prefix_dir, topdown=False):
+        if root != prefix_dir and not os.listdir(root):
+            os.rmdir(root)
+
+
+# Strip the ELF binaries and static libraries of the prefix. With split_debug, debug information of the binaries
+# is kept in .debug/<name>.debug files next to them, linked from the binaries with .gnu_debuglink, where gdb
+# looks for them; without strip only debug information is removed.
+def strip_prefix(prefix_dir, strip=True, split_debug=False):
+    for root, dirs, files in os.walk(prefix_dir):
+        dirs[:] = [name for name in dirs if name != ".debug"]
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                continue
+            kind = binary_kind(path)
+            if kind is None:
+                continue
+            with open(path, "rb") as binary_file:
+                debug_info = b".debug_info" in binary_file.read()
+            if not strip and not debug_info:
+                continue
+
+            mode = os.stat(path).st_mode
+            if os.stat(path).st_nlink > 1:
+                # strip may rewrite the file in place, which would change the other links too
+                shutil.copy2(path, path + ".tmp")
+                os.replace(path + ".tmp", path)
+            os.chmod(path, mode | 0o200)
+            strip_option = "--strip-unneeded" if strip and kind == "executable" else "--strip-debug"
+            if split_debug and debug_info and kind != "archive":
+                debug_file = os.path.join(root, ".debug", name + ".debug")
+                os.makedirs(os.path.dirname(debug_file), exist_ok=True)
+                execute_command(["objcopy", "--only-keep-debug", path, debug_file])
+                execute_command(["strip", strip_option, path])
+                execute_command(["objcopy", "--add-gnu-debuglink={}".format(debug_file), path])
+            else:
+                execute_command(["strip", strip_option, path])
+            os.chmod(path, mode)
+
+
+def write_artifact(filename, prefix_dir, compression):
+    if compression == "zstd":
+        import zstandard
+        with open(filename, "wb") as artifact_file:
+            with zstandard.ZstdCompressor(threads=-1).stream_writer(artifact_file) as writer:
+                with tarfile.open(fileobj=writer, mode="w|") as archive:
+                    archive.add(prefix_dir, arcname=".")
+    elif compression == "xz":
+        with tarfile.open(filename, "w:xz") as archive:
+            archive.add(prefix_dir, arcname=".")
+    else:
+        raise RuntimeError("Unknown artifact compression {}".format(compression))
+
+
+def read_artifact(filename, prefix_dir):
+    with open(filename, "rb") as artifact_file:
+        if filename.endswith(".zst"):
+            import zstandard
+            extract_tar(zstandard.ZstdDecompressor().stream_reader(artifact_file), prefix_dir, "r|")
+        else:
+            extract_tar(artifact_file, prefix_dir)
+
+
+# Recreate the directory tree with hardlinks to the files of source, so an in-source build gets its
+# own tree without copying the sources; files that can't be linked, e.g. on another file system, are copied
+def link_tree(source, destination):
+    for root, dirs, files in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            elif name in files:
+                try:
+                    os.link(path, os.path.join(target, name))
+                except OSError:
+                    shutil.copy2(path, os.path.join(target, name))
+
+
+# Directory -> lock of extracting it into the source store, so concurrent toolchains extract every
+# archive once, or of staging prefixes into it as a sysroot
+directory_locks = collections.defaultdict(threading.Lock)
+directory_locks_lock = threading.Lock()
+
+
+def directory_lock(path):
+    with directory_locks_lock:
+        return directory_locks[path]
+
+
+# Relative path -> labels of the prefixes that staged the file into the sysroot
+SYSROOT_MANIFEST = ".builder-sysroot.json"
+
+
+def staged_file_matches(target, kind, value):
+    if kind == "symlink":
+        return os.path.islink(target) and os.readlink(target) == value
+    if os.path.islink(target) or not os.path.isfile(target):
+        return False
+    if kind == "data":
+        with open(target, "rb") as target_file:
+            return target_file.read() == value
+    return os.path.samefile(target, value) or filecmp.cmp(target, value, shallow=False)
+
+
+# Stage the files of the prefix into the merged sysroot on behalf of owner (prefix label). Files are
+# hardlinked, text files mentioning prefix_dir are copied with the path replaced by the sysroot. A file
+# that another prefix staged with different contents is a conflict, and then nothing is staged at all.
+# Files staged by the owner before are replaced.
+def stage_prefix(prefix_dir, sysroot, owner):
+    manifest_path = os.path.join(sysroot, SYSROOT_MANIFEST)
+    owners = dict()
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            owners = json.load(manifest_file)
+
+    # relative path -> ("symlink", target), ("data", relocated contents) or ("link", path in the prefix)
+    staged = dict()
+    for root, dirs, files in os.walk(prefix_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, prefix_dir)
+            if os.path.islink(path):
+                staged[relative] = ("symlink", os.readlink(path).replace(prefix_dir, sysroot))
+                continue
+            if name not in files:
+                continue
+            data = read_text_file(path)
+            if data is not None and prefix_dir.encode() in data:
+                staged[relative] = ("data", data.replace(prefix_dir.encode(), sysroot.encode()))
+                continue
+            staged[relative] = ("link", path)
+
+    conflicts = []
+    for relative, (kind, value) in sorted(staged.items()):
+        target = os.path.join(sysroot, relative)
+        others = [other for other in owners.get(relative, []) if other != owner]
+        if others and os.path.lexists(target) and not staged_file_matches(target, kind, value):
+            conflicts.append("{} (staged by {})".format(relative, ", ".join(others)))
+    if conflicts:
+        raise RuntimeError("Files of {} conflict with sysroot {}: {}".format(owner, sysroot, "; ".join(conflicts)))
+
+    for relative, file_owners in list(owners.items()):
+        if owner in file_owners:
+            file_owners.remove(owner)
+            if not file_owners:
+                del owners[relative]
+                if os.path.lexists(os.path.join(sysroot, relative)):
+                    os.remove(os.path.join(sysroot, relative))
+
+    for relative, (kind, value) in sorted(staged.items()):
+        owners.setdefault(relative, []).append(owner)
+        target = os.path.join(sysroot, relative)
+        if len(owners[relative]) > 1 and os.path.lexists(target):
+            # the same file staged by another prefix is shared
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.remove(target)
+        if kind == "symlink":
+            os.symlink(value, target)
+        elif kind == "data":
+            with open(target, "wb") as target_file:
+                target_file.write(value)
+            shutil.copymode(os.path.join(prefix_dir, relative), target)
+        else:
+            try:
+                os.link(value, target)
+            except OSError:
+                shutil.copy2(value, target)
+
+    write_qt_conf(sysroot)
+
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(owners, manifest_file, indent=4, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+# URL -> (future of the background download started by Builder.prefetch, download directory)
+prefetches = dict()
+prefetches_lock = threading.Lock()
+
+
+# Raised by a probing builder where the recipe would have to be built, see Builder.cached_recipes
+class CacheMiss(Exception):
+    pass
+
+
+# Tool -> (version downloaded when there is no suitable one, minimum version used from PATH or the tool cache)
+TOOL_VERSIONS = {
+    "cmake": ("3.21.1", "3.13"),
+    "ninja": ("1.10.2", "1.8"),
+}
+
+
+# Return the version of the tool from the output of "<binary> --version" as a tuple of ints, or None
+def tool_version(binary):
+    try:
+        output = subprocess.run([binary, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r"(\d+)\.(\d+)(?:\.(\d+))?", output)
+    if match is None:
+        return None
+    return tuple(int(number) for number in match.groups() if number is not None)
+
+
+# Default per-user directory of the tools shared by all the workspaces
+def default_tool_cache_dir():
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "builder", "tools")
+
+
+# Hold an exclusive lock of the file between processes, e.g. of several workspaces installing the same tool
+@contextlib.contextmanager
+def file_lock(filename):
+    with open(filename, "a+") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 attempts
+                    pass
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+Recipe = collections.namedtuple("Recipe", ["method", "prefix", "deps", "url"])
+
+
+# Recipe label -> Builder method, key in Builder.prefixes, labels of recipes it depends on and
+# source archive URL template ({version}, {major}, {minor} and {patch} are substituted).
+RECIPES = {
+    "yaml_cpp"      : Recipe("build_yaml_cpp", "yaml-cpp", [],
+                             "https://github.com/jbeder/yaml-cpp/archive/yaml-cpp-{version}.tar.gz"),
+    "cyrus_sasl"    : Recipe("build_cyrus_sasl", "cyrus-sasl", [],
+                             "https://github.com/cyrusimap/cyrus-sasl/releases/download/cyrus-sasl-{version}/cyrus-sasl-{version}.tar.gz"),
+    "date"          : Recipe("build_date", "date", [],
+                             "https://github.com/HowardHinnant/date/archive/v{version}.tar.gz"),
+    "sqlpp11"       : Recipe("build_sqlpp11", "sqlpp11", ["date"],
+                             "https://github.com/rbock/sqlpp11/archive/{version}.tar.gz"),
+    "sqlpp11_mysql" : Recipe("build_sqlpp11_mysql", "sqlpp11-mysql", ["sqlpp11", "date"],
+                             "https://github.com/kovdan01/sqlpp11-connector-mysql/archive/refs/tags/{version}.tar.gz"),
+    "catch2"        : Recipe("build_catch2", "catch2", [],
+                             "https://github.com/catchorg/Catch2/archive/v{version}.tar.gz"),
+    "boost"         : Recipe("build_boost", "boost", [],
+                             "https://boostorg.jfrog.io/artifactory/main/release/{version}/source/boost_{major}_{minor}_{patch}.tar.bz2"),
+    "qt5base"       : Recipe("build_qt5base", "qt5base", [],
+                             "http://download.qt.io/official_releases/qt/{major}.{minor}/{version}/submodules/qtbase-everywhere-src-{version}.tar.xz"),
+    "qt5tools"      : Recipe("build_qt5tools", "qt5tools", ["qt5base"],
+                             "http://download.qt.io/official_releases/qt/{major}.{minor}/{version}/submodules/qttools-everywhere-src-{version}.tar.xz"),
+    "liboath"       : Recipe("build_liboath", "liboath", [],
+                             "https://download.savannah.nongnu.org/releases/oath-toolkit/oath-toolkit-{version}.tar.gz"),
+}
+
+# Recipes built by all.sh.
+DEFAULT_RECIPES = ["yaml_cpp", "cyrus_sasl", "date", "sqlpp11", "catch2", "boost"]
+
+
+def resolve_recipes(labels):
+    order = []
+
+    def visit(label, stack):
+        if label not in RECIPES:
+            raise RuntimeError("Unknown recipe {}".format(label))
+        if label in stack:
+            raise RuntimeError("Dependency cycle: {}".format(" -> ".join(stack + [label])))
+        if label in order:
+            return
+        for dep in RECIPES[label].deps:
+            visit(dep, stack + [label])
+        order.append(label)
+
+    for label in labels:
+        visit(label, [])
+    return order
+
+
+# Return the short hash identifying the lock entry of a recipe, see Builder.lock_entry
+def lock_digest(entry):
+    return hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# Return the recipes of the lockfile, see Builder.write_lockfile, or an empty dict if there is no lockfile
+def read_lockfile(filename):
+    if not os.path.isfile(filename):
+        return dict()
+    with open(filename) as lockfile:
+        return json.load(lockfile)["recipes"]
+
+
+def recipe_version(label):
+    return inspect.signature(getattr(Builder, RECIPES[label].method)).parameters["version"].default
+
+
+def recipe_url(label, version=None):
+    if version is None:
+        version = recipe_version(label)
+    parts = version.split(".") + ["", ""]
+    return RECIPES[label].url.format(version=version, major=parts[0], minor=parts[1], patch=parts[2])
+
+
+# Build profiles: compiler flags and linker flags (ldflags) used by all the build systems, CMake variables
+# and extra b2 properties and Qt configure options; {profile_data} is the profile data directory of the recipe
+PROFILES = {
+    "lto": {"flags": ["-flto"], "ldflags": ["-flto"],
+            "cmake": {"CMAKE_INTERPROCEDURAL_OPTIMIZATION": "ON"}, "qmake": ["-ltcg"]},
+    "native": {"flags": ["-march=native", "-mtune=native"]},
+    "size": {"flags": ["-Os"], "cmake": {"CMAKE_BUILD_TYPE": "MinSizeRel"},
+             "b2": ["optimization=space"], "qmake": ["-optimize-size"]},
+    "pgo-generate": {"flags": ["-fprofile-generate={profile_data}"], "ldflags": ["-fprofile-generate={profile_data}"]},
+    "pgo-use": {"flags": ["-fprofile-use={profile_data}"], "ldflags": ["-fprofile-use={profile_data}"]},
+}
+
+
+# "lto,native" -> ["lto", "native"]
+def parse_profile(text):
+    profile = [name.strip() for name in text.split(",") if name.strip()]
+    for name in profile:
+        if name not in PROFILES:
+            raise RuntimeError("Unknown build profile {}, expected one of {}".format(name, ", ".join(PROFILES)))
+    if "pgo-generate" in profile and "pgo-use" in profile:
+        raise RuntimeError("Build profiles pgo-generate and pgo-use can't be used together")
+    return profile
+
+
+# Labels of the recipes that depend on the given one, directly or through other recipes
+def dependent_recipes(label, labels):
+    dependents = []
+    for candidate in labels:
+        deps = list(RECIPES[candidate].deps)
+        while deps:
+            dep = deps.pop()
+            if dep == label:
+                dependents.append(candidate)
+                break
+            deps.extend(RECIPES[dep].deps)
+    return dependents
+
+
+def critical_path(durations):
+    finish = dict()
+    previous = dict()
+    for label in durations:
+        deps = [dep for dep in RECIPES[label].deps if dep in finish]
+        previous[label] = max(deps, key=lambda dep: finish[dep], default=None)
+        finish[label] = durations[label] + (finish[previous[label]] if previous[label] else 0.0)
+
+    path = []
+    label = max(finish, key=lambda l: finish[l], default=None)
+    while label is not None:
+        path.insert(0, label)
+        label = previous[label]
+    return path
+
+
+# Split jobs between the recipes in proportion to their costs; every recipe gets at least one job
+# and the jobs left over by rounding go to the costliest ones
+def job_shares(jobs, costs):
+    total = sum(costs.values()) or 1.0
+    spare = max(jobs - len(costs), 0)
+    shares = {label: 1 + int(spare * cost / total) for label, cost in costs.items()}
+    for label in sorted(costs, key=costs.get, reverse=True)[:max(jobs - sum(shares.values()), 0)]:
+        shares[label] += 1
+    return shares
+
+
 class Builder:
     """
     Class members:
     - cmake_binary;
     - ninja_binary;
+    - tool_cache_dir: per-user directory CMake and Ninja are installed into when there is no suitable one on PATH;
     - c_compiler;
     - cxx_compiler;
+    - jobs: number of parallel jobs passed to the build tools;
+    - jobserver: JobServer used by make instead of jobs or None;
+    - cache_dir: directory of the build cache or None if the cache is disabled;
+    - download_dir: directory of the downloaded archives cache or None if the cache is disabled;
+    - artifact_dir: directory of packed installation prefixes shared between machines or None;
+    - artifact_compression: "xz" or "zstd" (requires zstandard module);
+    - checksums: dict from str (archive label) to str (expected archive SHA256);
+    - compiler_launcher: compiler cache (ccache or sccache) every compilation is run with or None;
+    - compiler_cache_dir: directory of the compiler cache or None for the launcher's default;
+    - compiler_cache_stats: dict from str (recipe label) to dict of compiler cache hits and misses;
+    - recipe_durations: dict from str (recipe label) to the seconds its last build took, see expected_costs;
+    - recipe: label of the recipe being built by run_recipe or None;
+    - source_store: directory the archives are extracted to once and kept read-only, or None to extract them
+      into the current directory and build there;
+    - work_dir: directory of the build and prefix directories and of the source trees of in-source builds,
+      or None to use the source directories;
+    - scratch_dir: directory (e.g. on tmpfs) recipes run by run_recipe extract and build in, leaving only
+      the prefixes in the work directory, or None; see build_recipe;
+    - recipe_scratch_dir: scratch directory of the recipe being built by run_recipe or None;
+    - probing: whether recipes only look up the build cache, see cached_recipes;
+    - toolchain: name of the toolchain of a matrix build (see toolchain_builder) or None;
+    - sysroot: directory every built prefix is staged into by run_recipe (see stage) or None;
+    - profile: list of build profile names, see PROFILES;
+    - profile_data_dir: directory of PGO profile data, one subdirectory per recipe;
+    - install_policies: dict from str (recipe label or "*" for every recipe) to dict of what is installed:
+      "strip" and "split_debug" bools, "components" list of CMake install components and "exclude" list
+      of patterns of prefix paths to remove, see install_policy;
+    - log_dir: directory of the per-recipe logs of the commands run by run_recipe or None to print their output;
+    - timeouts: dict from str (phase name, e.g. "configure") to its timeout in seconds, see phase_timeout;
+    - on_failure: what build_recipes does with independent recipes when one fails: "finish" the running ones,
+      "keep-going" building everything that does not depend on it, or "kill" the running ones;
+    - memory_limit: number of bytes the RSS of all the build processes should stay under or None, see ResourceMonitor;
+    - incremental: reuse extracted sources, build and prefix directories, re-running configure only if its command or the compilers changed;
+    - timings: list of phases of the recipes built by run_recipe, see write_timings;
+    - locked_inputs: dict from str (recipe label) to lock entry (see lock_entry) of the recipes built by run_recipe;
     - prefixes: dict from str (library label) to str (library prefix).
     """
 
-    def __init__(self, c_compiler=None, cxx_compiler=None, platform=None):
+    def __init__(self, c_compiler=None, cxx_compiler=None, platform=None, jobs=None, cache_dir=None,
+                 download_dir=None, compiler_launcher=None, compiler_cache_dir=None, artifact_dir=None,
+                 artifact_compression=None, memory_limit=None, log_dir=None, timeouts=None, on_failure=None,
+                 source_store=None, work_dir=None, profile=None, profile_data_dir=None, sysroot=None,
+                 tool_cache_dir=None, scratch_dir=None, install_policies=None):
         self.platform = get_platform()
         self.prefixes = dict()
+        self.checksums = dict()
+        self.compiler_cache_stats = dict()
+        self.recipe_durations = dict()
+        self.recipe = None
+        self.recipe_scratch_dir = None
+        self.probing = False
+        self.toolchain = None
+        self.timings = []
+        self.locked_inputs = dict()
+        self.incremental = os.environ.get("BUILDER_INCREMENTAL", "") not in ("", "0")
+
+        if compiler_launcher is None:
+            compiler_launcher = os.environ.get("BUILDER_COMPILER_LAUNCHER")
+        self.compiler_launcher = compiler_launcher or None
+
+        if compiler_cache_dir is None:
+            compiler_cache_dir = os.environ.get("BUILDER_COMPILER_CACHE_DIR")
+        self.compiler_cache_dir = os.path.abspath(compiler_cache_dir) if compiler_cache_dir else None
+
+        if artifact_dir is None:
+            artifact_dir = os.environ.get("BUILDER_ARTIFACT_DIR")
+        self.artifact_dir = os.path.abspath(artifact_dir) if artifact_dir else None
+
+        if artifact_compression is None:
+            artifact_compression = os.environ.get("BUILDER_ARTIFACT_COMPRESSION", "xz")
+        self.artifact_compression = artifact_compression
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("BUILDER_CACHE_DIR")
+        if not cache_dir and self.artifact_dir is not None:
+            # artifacts are restored into the build cache
+            cache_dir = "cache"
+        self.cache_dir = os.path.abspath(cache_dir) if cache_dir else None
+
+        if download_dir is None:
+            download_dir = os.environ.get("BUILDER_DOWNLOAD_DIR")
+        self.download_dir = os.path.abspath(download_dir) if download_dir else None
+
+        if tool_cache_dir is None:
+            tool_cache_dir = os.environ.get("BUILDER_TOOL_CACHE_DIR") or default_tool_cache_dir()
+        self.tool_cache_dir = os.path.abspath(tool_cache_dir)
+
+        if memory_limit is None:
+            memory_limit = os.environ.get("BUILDER_MEMORY_LIMIT")
+        self.memory_limit = parse_size(memory_limit) if memory_limit else None
+
+        if source_store is None:
+            source_store = os.environ.get("BUILDER_SOURCE_STORE")
+        self.source_store = os.path.abspath(source_store) if source_store else None
+
+        if work_dir is None:
+            work_dir = os.environ.get("BUILDER_WORK_DIR")
+        self.work_dir = os.path.abspath(work_dir) if work_dir else None
+
+        if scratch_dir is None:
+            scratch_dir = os.environ.get("BUILDER_SCRATCH_DIR")
+        self.scratch_dir = os.path.abspath(scratch_dir) if scratch_dir else None
+
+        if sysroot is None:
+            sysroot = os.environ.get("BUILDER_SYSROOT")
+        self.sysroot = os.path.abspath(sysroot) if sysroot else None
+
+        if profile is None:
+            profile = parse_profile(os.environ.get("BUILDER_PROFILE", ""))
+        self.profile = list(profile)
+
+        if profile_data_dir is None:
+            profile_data_dir = os.environ.get("BUILDER_PROFILE_DATA_DIR", "profile-data")
+        self.profile_data_dir = os.path.abspath(profile_data_dir)
+
+        if install_policies is None:
+            # e.g. BUILDER_INSTALL_POLICIES='{"*": {"strip": true}, "qt5base": {"exclude": ["doc/**"]}}'
+            install_policies = json.loads(os.environ.get("BUILDER_INSTALL_POLICIES") or "{}")
+        self.install_policies = {label: dict(policy) for label, policy in install_policies.items()}
+
+        if log_dir is None:
+            log_dir = os.environ.get("BUILDER_LOG_DIR", "logs")
+        self.log_dir = os.path.abspath(log_dir) if log_dir else None
+
+        if timeouts is None:
+            # e.g. BUILDER_TIMEOUTS="configure=600,compile=7200"
+            timeouts = dict()
+            for item in os.environ.get("BUILDER_TIMEOUTS", "").split(","):
+                if item.strip():
+                    name, seconds = item.split("=")
+                    timeouts[name.strip()] = float(seconds)
+        self.timeouts = dict(timeouts)
+
+        if on_failure is None:
+            on_failure = os.environ.get("BUILDER_ON_FAILURE", "finish")
+        if on_failure not in ("finish", "keep-going", "kill"):
+            raise RuntimeError("Unknown failure policy {}".format(on_failure))
+        self.on_failure = on_failure
+
+        self.jobserver = None
+        if jobs is None:
+            self.jobs = int(os.environ.get("BUILDER_JOBS", available_cpus()))
+        else:
+            self.jobs = jobs
 
         if c_compiler is None:
             try:
@@ -103,95 +1353,1214 @@ class Builder:
             self.cxx_compiler = cxx_compiler
 
 
-    """Configure, build and install project with CMake; return installation prefix."""
-    def build_cmake(self, source_dir, cmake_params=None, prefix_dir=None,
-                    build_dir=None, build_type="Release"):
+    """Download and extract archive using the downloaded archives cache and the checksum pinned for the label.
 
-        prefix_dir = check_prefix_dif(prefix_dir, source_dir)
-        build_dir = check_build_dir(build_dir, source_dir)
+    If the archive is being prefetched, wait for that download instead of starting another one; an
+    archive prefetched outside the download cache is removed once extracted. Only archive members
+    selected by include and exclude patterns are extracted, see member_filter.
+    """
+    def download(self, url, label, include=None, exclude=None, directory="."):
+        download_dir = self.download_dir
+        with prefetches_lock:
+            prefetch = prefetches.get(url)
+        if prefetch is not None:
+            future, download_dir = prefetch
+            with phase("download"):
+                future.result()
+        download_and_extract_archive(url=url, label=label, download_dir=download_dir,
+                                     sha256=self.checksums.get(label), include=include, exclude=exclude,
+                                     directory=directory)
+        if download_dir is not None and download_dir != self.download_dir:
+            with prefetches_lock:
+                prefetches.pop(url, None)
+            try:
+                os.remove(cached_archive_name(download_dir, url))
+            except FileNotFoundError:
+                # removed by another toolchain extracting the same archive
+                pass
+
+
+    """Download and extract archive, unless incremental mode finds source_dir already extracted the same way.
+
+    With a source store, the archive is extracted into it only once, the files are made read-only and
+    every toolchain builds from there. Otherwise it is extracted into the scratch directory of the
+    recipe if there is one. Return the directory of the sources.
+    """
+    def fetch_source(self, url, label, source_dir, include=None, exclude=None):
+        if self.probing:
+            raise CacheMiss()
+        source = json.dumps({"url": url, "include": include, "exclude": exclude}, sort_keys=True)
+        if self.source_store is None:
+            directory = "."
+            if self.recipe_scratch_dir is not None:
+                directory = self.recipe_scratch_dir
+                source_dir = os.path.join(directory, source_dir)
+            stamp = os.path.join(source_dir, ".builder-source")
+            if self.incremental and os.path.isfile(stamp):
+                with open(stamp) as stamp_file:
+                    if stamp_file.read() == source:
+                        print("Reusing sources in {}".format(source_dir))
+                        return source_dir
+            self.download(url=url, label=label, include=include, exclude=exclude, directory=directory)
+            with open(stamp, "w") as stamp_file:
+                stamp_file.write(source)
+            return source_dir
+
+        source_path = os.path.join(self.source_store, source_dir)
+        stamp = os.path.join(source_path, ".builder-source")
+        with directory_lock(source_path):
+            if os.path.isfile(stamp):
+                with open(stamp) as stamp_file:
+                    if stamp_file.read() == source:
+                        return source_path
+
+            # extracted next to the store and moved into it, so an interrupted extraction leaves nothing behind
+            os.makedirs(self.source_store, exist_ok=True)
+            temp_dir = tempfile.mkdtemp(prefix=".extract-", dir=self.source_store)
+            try:
+                self.download(url=url, label=label, include=include, exclude=exclude, directory=temp_dir)
+                with open(os.path.join(temp_dir, source_dir, ".builder-source"), "w") as stamp_file:
+                    stamp_file.write(source)
+                for root, dirs, files in os.walk(temp_dir):
+                    for name in files:
+                        path = os.path.join(root, name)
+                        if not os.path.islink(path):
+                            os.chmod(path, os.stat(path).st_mode & ~0o222)
+                for name in os.listdir(temp_dir):
+                    if os.path.isdir(os.path.join(self.source_store, name)):
+                        shutil.rmtree(os.path.join(self.source_store, name))
+                    os.replace(os.path.join(temp_dir, name), os.path.join(self.source_store, name))
+            finally:
+                shutil.rmtree(temp_dir)
+        return source_path
+
+
+    """Return the directory for the build and prefix directories of source_dir, creating it if needed.
+
+    With a scratch directory of the recipe it is there, see prefix_path for the prefix directories then.
+    """
+    def work_path(self, source_dir):
+        if self.recipe_scratch_dir is not None:
+            path = os.path.join(self.recipe_scratch_dir, source_dir)
+        elif self.work_dir is None and self.source_store is None:
+            return source_dir
+        else:
+            path = os.path.join(self.work_dir or os.path.abspath("."), source_dir)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+
+    """Return the directory for the prefix directories of source_dir, which outlives the scratch directory."""
+    def prefix_path(self, source_dir):
+        if self.recipe_scratch_dir is None:
+            return self.work_path(source_dir)
+        path = os.path.join(self.work_dir or os.path.abspath("."), source_dir)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+
+    """Return a writable tree of source_path (see fetch_source) for tools that build in the source directory.
+
+    Without a source store, the sources themselves. Otherwise a tree of hardlinks to the source
+    store in the work directory, which is created again unless incremental mode may reuse it.
+    Files in the tree must be unlinked rather than rewritten, not to change the source store.
+    """
+    def source_tree(self, source_dir, source_path):
+        if self.source_store is None:
+            return source_path
+        tree = self.work_path(source_dir)
+        stamp = os.path.join(tree, ".builder-source")
+        if self.incremental and os.path.isfile(stamp):
+            with open(stamp) as stamp_file, open(os.path.join(source_path, ".builder-source")) as source_file:
+                if stamp_file.read() == source_file.read():
+                    return tree
+        shutil.rmtree(tree)
+        link_tree(source_path, tree)
+        return tree
+
+
+    """Return the flags of the build profile for the recipe.
+
+    The result has the same keys as PROFILES items: "flags" and "ldflags" lists, "cmake" dict of
+    CMake variables and "b2" and "qmake" lists. With pgo-generate the profile data directory of
+    the recipe is created, with pgo-use it must exist.
+    """
+    def profile_flags(self, label):
+        flags = {"flags": [], "ldflags": [], "cmake": dict(), "b2": [], "qmake": []}
+        profile_data = os.path.join(self.profile_data_dir, self.recipe_key(label))
+        for name in self.profile:
+            for key, value in PROFILES[name].items():
+                if key == "cmake":
+                    flags[key].update(value)
+                else:
+                    flags[key].extend(item.format(profile_data=profile_data) for item in value)
+
+        if "pgo-generate" in self.profile:
+            os.makedirs(profile_data, exist_ok=True)
+        if "pgo-use" in self.profile and not os.path.isdir(profile_data):
+            raise RuntimeError("No profile data in {}, build with pgo-generate profile and run the training first".format(
+                profile_data))
+        return flags
+
+
+    """Return build cache inputs of the build profile: its names and the hash of the PGO profile data used.
+
+    With the native profile, what -march=native resolves to is added, so that machines with different
+    CPUs do not share the builds.
+    """
+    def profile_inputs(self, label):
+        if not self.profile:
+            return dict()
+        inputs = {"profile": list(self.profile)}
+        if "native" in self.profile:
+            inputs["native_target"] = [native_target(self.c_compiler), native_target(self.cxx_compiler)]
+        if "pgo-use" in self.profile:
+            profile_data = os.path.join(self.profile_data_dir, self.recipe_key(label))
+            digest = hashlib.sha256()
+            for root, dirs, files in sorted(os.walk(profile_data)):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    digest.update("{}\0{}\0".format(os.path.relpath(path, profile_data), file_sha256(path)).encode())
+            inputs["profile_data"] = digest.hexdigest()
+        return inputs
+
+
+    """Use the build profile; if it changed, the prefixes built with the previous one are forgotten.
+
+    They are not what was asked for, though they may still be in the build cache.
+    """
+    def set_profile(self, profile):
+        profile = list(profile)
+        if profile != self.profile:
+            self.profile = profile
+            self.prefixes.clear()
+
+
+    """Use the compilers; if they changed, the prefixes built with the previous ones are forgotten.
+
+    Compilers are compared by their identities, see compiler_identity.
+    """
+    def set_compilers(self, c_compiler, cxx_compiler):
+        previous = [compiler_identity(self.c_compiler), compiler_identity(self.cxx_compiler)]
+        self.c_compiler, self.cxx_compiler = c_compiler, cxx_compiler
+        if [compiler_identity(c_compiler), compiler_identity(cxx_compiler)] != previous:
+            self.prefixes.clear()
 
-        if cmake_params is None:
-            cmake_params = ""
 
-        execute_command("{} ".format(self.cmake_binary) +
-                        "-S {} ".format(source_dir) +
-                        "-B {} ".format(build_dir) +
-                        "-G Ninja " +
-                        "-D CMAKE_MAKE_PROGRAM={} ".format(self.ninja_binary) +
-                        "-D CMAKE_INSTALL_PREFIX={} ".format(prefix_dir) +
-                        "-D CMAKE_BUILD_TYPE={} ".format(build_type) +
-                        "-D CMAKE_C_COMPILER={} ".format(self.c_compiler) +
-                        "-D CMAKE_CXX_COMPILER={} ".format(self.cxx_compiler) +
-                        "{} ".format(cmake_params))
+    """Use the install policies; the prefixes of the recipes whose policy changed are forgotten."""
+    def set_install_policies(self, install_policies):
+        previous = {label: self.install_policy(label) for label in RECIPES}
+        self.install_policies = {label: dict(policy) for label, policy in install_policies.items()}
+        for label in RECIPES:
+            if self.install_policy(label) != previous[label]:
+                self.prefixes.pop(RECIPES[label].prefix, None)
 
-        execute_command("{} --build {} --target all".format(self.cmake_binary, build_dir))
-        execute_command("{} --build {} --target install".format(self.cmake_binary, build_dir))
 
+    """Return the install policy of the recipe: the "*" policy updated with the policy of the recipe.
+
+    "strip" strips the binaries, "split_debug" moves their debug information to .debug directories,
+    "components" installs only these components of a CMake project and "exclude" removes the paths
+    of the prefix matching the patterns (see member_filter; the lists of both policies are joined).
+    """
+    def install_policy(self, label):
+        policy = {"strip": False, "split_debug": False, "components": [], "exclude": []}
+        for key in ("*", label):
+            for name, value in self.install_policies.get(key, dict()).items():
+                if name not in policy:
+                    raise RuntimeError("Unknown install policy {} of {}".format(name, key))
+                if name == "exclude":
+                    policy[name] = policy[name] + list(value)
+                else:
+                    policy[name] = value
+        return policy
+
+
+    """Return build cache inputs of the install policy of the recipe, empty if it installs everything."""
+    def install_inputs(self, label):
+        policy = self.install_policy(label)
+        if not any(policy.values()):
+            return dict()
+        return {"install": policy}
+
+
+    """Trim the installed prefix according to the install policy of the recipe, before it is cached.
+
+    CMake components are installed by build_cmake itself, other backends fail if the policy has them.
+    """
+    def trim_install(self, label, prefix_dir, components_installed=False):
+        policy = self.install_policy(label)
+        if policy["components"] and not components_installed:
+            raise RuntimeError("Install components are supported only by CMake projects, not by {}".format(label))
+        if not policy["exclude"] and not policy["strip"] and not policy["split_debug"]:
+            return
+        with phase("trim"):
+            if policy["exclude"]:
+                exclude_from_prefix(prefix_dir, policy["exclude"])
+            if policy["strip"] or policy["split_debug"]:
+                if self.platform == "Linux":
+                    strip_prefix(prefix_dir, policy["strip"], policy["split_debug"])
+                else:
+                    print("Stripping is supported only on Linux, {} is not stripped".format(prefix_dir))
+
+
+    """Return name of the build directory for the build cache inputs (None without the cache).
+
+    There is one build directory per cache key, so a cache miss does not collide with the build
+    directory left by other inputs, e.g. another compiler. Both PGO stages use the same build
+    directory: GCC names the profile data of an object file after its path.
+    """
+    def build_name(self, inputs=None):
+        profile = ["pgo" if name in ("pgo-generate", "pgo-use") else name for name in self.profile]
+        name = "build"
+        if profile:
+            name += "-" + "+".join(profile)
+        if inputs is None:
+            return name
+        if profile:
+            inputs = dict(inputs, profile=profile)
+            inputs.pop("profile_data", None)
+        return name + "-" + self.cache_key(inputs)[:12]
+
+
+    """Return suffix of the build and prefix directories for the build profile, e.g. "-lto+native"."""
+    def profile_suffix(self):
+        if not self.profile:
+            return ""
+        return "-" + "+".join(self.profile)
+
+
+    """Return the label of the recipe qualified with the toolchain for logs, timings and cancellation."""
+    def recipe_key(self, label):
+        if self.toolchain is None:
+            return label
+        return "{}/{}".format(self.toolchain, label)
+
+
+    """Return a builder for another toolchain of a matrix build.
+
+    It shares the settings, the caches and the source store (which is "sources" if not set), and
+    has its own prefixes, work directory <work_dir>/<name>, log directory <log_dir>/<name> and sysroot
+    <sysroot>/<name>, so several toolchains may be built at the same time, see build_matrix.
+    """
+    def toolchain_builder(self, name, c_compiler, cxx_compiler):
+        builder = copy.copy(self)
+        builder.toolchain = name
+        builder.c_compiler = c_compiler
+        builder.cxx_compiler = cxx_compiler
+        builder.prefixes = dict()
+        builder.checksums = dict(self.checksums)
+        builder.compiler_cache_stats = dict()
+        builder.recipe_durations = dict(self.recipe_durations)
+        builder.timings = []
+        builder.locked_inputs = dict()
+        builder.timeouts = dict(self.timeouts)
+        builder.source_store = self.source_store or os.path.abspath("sources")
+        builder.work_dir = os.path.join(self.work_dir or os.path.abspath("."), name)
+        if self.log_dir is not None:
+            builder.log_dir = os.path.join(self.log_dir, name)
+        if self.sysroot is not None:
+            builder.sysroot = os.path.join(self.sysroot, name)
+        return builder
+
+
+    """Return whether configure command already succeeded in build_dir with the same compilers and may be skipped.
+
+    Only in incremental mode. If the compilers changed, configure is run again and a separate build
+    directory is emptied first; an in-source build is left as it is.
+    """
+    def configured(self, build_dir, command, separate_build_dir=True):
+        stamp = os.path.join(build_dir, ".builder-configure")
+        if not self.incremental or not os.path.isfile(stamp):
+            return False
+        with open(stamp) as stamp_file:
+            configured = json.load(stamp_file)
+        compilers = [compiler_identity(self.c_compiler), compiler_identity(self.cxx_compiler)]
+        if configured["compilers"] != compilers:
+            if separate_build_dir:
+                print("Compilers changed, cleaning {}".format(build_dir))
+                shutil.rmtree(build_dir)
+                os.mkdir(build_dir)
+            return False
+        if configured["command"] != command:
+            return False
+        print("Configure command and compilers did not change, skipping configure in {}".format(build_dir))
+        return True
+
+
+    def mark_configured(self, build_dir, command):
+        with open(os.path.join(build_dir, ".builder-configure"), "w") as stamp_file:
+            json.dump({"command": command,
+                       "compilers": [compiler_identity(self.c_compiler), compiler_identity(self.cxx_compiler)]}, stamp_file)
+
+
+    """Start downloading archives of the recipes and of the tools ("cmake", "ninja") in the background.
+
+    At most max_downloads archives are downloaded at the same time. Archives are stored
+    in download_dir, or in "downloads" directory (of the scratch directory if there is one)
+    if the download cache is disabled; then download removes them once extracted.
+    """
+    def prefetch(self, labels, tools=(), max_downloads=4):
+        archives = [(recipe_url(label), label) for label in labels]
+        if "cmake" in tools:
+            archives.insert(0, (self.cmake_archive()[0], "cmake"))
+        if "ninja" in tools:
+            archives.insert(0, (self.ninja_archive()[0], "ninja"))
+        if not archives:
+            return
+
+        download_dir = self.download_dir or os.path.join(self.scratch_dir or os.path.abspath("."), "downloads")
+        if not os.path.isdir(download_dir):
+            os.makedirs(download_dir, exist_ok=True)
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_downloads)
+        with prefetches_lock:
+            for url, label in archives:
+                if url not in prefetches:
+                    future = pool.submit(download_archive, url, cached_archive_name(download_dir, url),
+                                         self.checksums.get(label))
+                    prefetches[url] = (future, download_dir)
+        pool.shutdown(wait=False)
+
+
+    """Return compiler command prefixed with the compiler launcher if there is one."""
+    def launched(self, compiler):
+        if self.compiler_launcher is None:
+            return compiler
+        return "{} {}".format(self.compiler_launcher, compiler)
+
+
+    """Return environment for build commands with compiler cache settings and the given variables."""
+    def environment(self, **variables):
+        env = dict(os.environ, **variables)
+        if self.compiler_launcher is not None:
+            sccache = os.path.basename(self.compiler_launcher).startswith("sccache")
+            if self.compiler_cache_dir is not None:
+                env["SCCACHE_DIR" if sccache else "CCACHE_DIR"] = self.compiler_cache_dir
+            if self.recipe is not None and not sccache:
+                env["CCACHE_STATSLOG"] = self.compiler_cache_log()
+        return env
+
+
+    """Return path of the ccache statistics log of the current recipe."""
+    def compiler_cache_log(self):
+        return os.path.join(os.path.abspath("compiler-cache-stats"), "{}.log".format(self.recipe))
+
+
+    """Return total compiler cache hits and misses of sccache server."""
+    def sccache_stats(self):
+        output = subprocess.run([self.compiler_launcher, "--show-stats", "--stats-format=json"],
+                                stdout=subprocess.PIPE, env=self.environment(), universal_newlines=True).stdout
+        stats = json.loads(output)["stats"]
+        return {"hits": sum(stats["cache_hits"]["counts"].values()),
+                "misses": sum(stats["cache_misses"]["counts"].values())}
+
+
+    """Return the build cache key of the given build inputs.
+
+    Compilers are identified by their --version output and the cache directory is
+    replaced with a placeholder, so upstream prefixes taken from the cache are
+    identified by their own keys.
+    """
+    def cache_key(self, inputs):
+        inputs = dict(inputs,
+                      c_compiler=compiler_identity(self.c_compiler),
+                      cxx_compiler=compiler_identity(self.cxx_compiler))
+        text = json.dumps(inputs, sort_keys=True)
+        if self.cache_dir is not None:
+            text = text.replace(self.cache_dir, "<cache>")
+        return hashlib.sha256(text.encode()).hexdigest()[:24]
+
+
+    """Return the cached installation prefix for the given build inputs or None on a cache miss.
+
+    A probing builder (see cached_recipes) raises CacheMiss instead of returning None.
+    """
+    def cache_lookup(self, inputs):
+        prefix_dir = None
+        if self.cache_dir is not None:
+            manifest = os.path.join(self.cache_dir, self.cache_key(inputs), "manifest.json")
+            if os.path.isfile(manifest):
+                with open(manifest) as manifest_file:
+                    prefix_dir = json.load(manifest_file)["prefix"]
+                if not os.path.isdir(prefix_dir):
+                    prefix_dir = None
+                elif not self.probing:
+                    print("Using cached {}".format(prefix_dir))
+            elif self.artifact_dir is not None:
+                prefix_dir = self.import_artifact(self.cache_key(inputs))
+        if prefix_dir is None and self.probing:
+            raise CacheMiss()
         return prefix_dir
 
 
-    """Configure project with configure script, build and install with make; return installation prefix."""
-    def build_make(self, source_dir, configure_params=None,
-                   prefix_dir=None, prefix_arg="--prefix=", build_dir=None):
+    """Return the pending recipes (in build order) that would be taken from the build cache as a whole.
 
-        current_dir = os.getcwd()
-        prefix_dir = check_prefix_dif(prefix_dir, source_dir)
-        build_dir = check_build_dir(build_dir, source_dir)
+    The recipes run on a probing copy of the builder, which stops at the first cache miss or source
+    download. Recipes depending on one that is not cached are not probed, since the prefixes they
+    would be built against are not known yet.
+    """
+    def cached_recipes(self, pending):
+        if self.cache_dir is None:
+            return []
+        probe = copy.copy(self)
+        probe.probing = True
+        probe.prefixes = dict(self.prefixes)
+        cached = []
+        for label in pending:
+            if any(dep in pending and dep not in cached for dep in RECIPES[label].deps):
+                continue
+            try:
+                getattr(probe, RECIPES[label].method)()
+            except CacheMiss:
+                continue
+            cached.append(label)
+        return cached
+
+
+    """Return the installation prefix inside the cache entry for the given build inputs, removing an incomplete entry."""
+    def cache_prefix(self, inputs):
+        entry_dir = os.path.join(self.cache_dir, self.cache_key(inputs))
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.makedirs(entry_dir)
+        return os.path.join(entry_dir, "prefix")
+
+
+    """Mark the cache entry for the given build inputs as complete."""
+    def cache_store(self, inputs, prefix_dir):
+        entry_dir = os.path.join(self.cache_dir, self.cache_key(inputs))
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        manifest = os.path.join(entry_dir, "manifest.json")
+        with open(manifest + ".tmp", "w") as manifest_file:
+            json.dump({"inputs": dict(inputs,
+                                      c_compiler=compiler_identity(self.c_compiler),
+                                      cxx_compiler=compiler_identity(self.cxx_compiler)),
+                       "prefix": prefix_dir}, manifest_file, indent=4, sort_keys=True)
+        os.replace(manifest + ".tmp", manifest)
+
+        if self.artifact_dir is not None and prefix_dir == os.path.join(entry_dir, "prefix"):
+            self.export_artifact(self.cache_key(inputs))
+
+
+    """Pack installation prefix of the complete cache entry into the artifact directory with a manifest of its inputs."""
+    def export_artifact(self, key):
+        with open(os.path.join(self.cache_dir, key, "manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest["cache_dir"] = self.cache_dir
+        manifest["compression"] = self.artifact_compression
+
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        artifact = os.path.join(self.artifact_dir, key + (".tar.zst" if self.artifact_compression == "zstd" else ".tar.xz"))
+        print("Exporting {} to {}...".format(manifest["prefix"], artifact))
+        write_artifact(artifact + ".tmp", manifest["prefix"], self.artifact_compression)
+        os.replace(artifact + ".tmp", artifact)
+
+        # the manifest is written last, so an artifact without one is incomplete
+        manifest_path = os.path.join(self.artifact_dir, key + ".json")
+        with open(manifest_path + ".tmp", "w") as manifest_file:
+            json.dump(dict(manifest, artifact=os.path.basename(artifact)), manifest_file, indent=4, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        print("Done!")
+
+
+    """Restore artifact into the build cache, relocating absolute paths; return the installation prefix or None if there is no artifact."""
+    def import_artifact(self, key):
+        manifest_path = os.path.join(self.artifact_dir, key + ".json")
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        prefix_dir = os.path.join(entry_dir, "prefix")
+        os.makedirs(prefix_dir)
+
+        artifact = os.path.join(self.artifact_dir, manifest["artifact"])
+        print("Restoring {} into {}...".format(artifact, prefix_dir))
+        read_artifact(artifact, prefix_dir)
+        relocate_prefix(prefix_dir, [(manifest["prefix"], prefix_dir), (manifest["cache_dir"], self.cache_dir)])
+
+        manifest_path = os.path.join(entry_dir, "manifest.json")
+        with open(manifest_path + ".tmp", "w") as manifest_file:
+            json.dump({"inputs": manifest["inputs"], "prefix": prefix_dir}, manifest_file, indent=4, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        print("Done!")
+        return prefix_dir
+
+
+    """Configure, build and install project with CMake; return installation prefix.
+
+    If url is given, the archive is downloaded and extracted first; extract_include and extract_exclude
+    patterns limit what is extracted. Unless prefix_dir is given, the build cache is looked up before
+    and filled after the build.
+    """
+    def build_cmake(self, source_dir, cmake_params=None, prefix_dir=None,
+                    build_dir=None, build_type="Release", url=None, label="temp",
+                    extract_include=None, extract_exclude=None):
+
+        if cmake_params is None:
+            cmake_params = ""
+
+        inputs = None
+        if url is not None and prefix_dir is None and self.cache_dir is not None:
+            inputs = dict({"backend": "cmake", "url": url, "cmake_params": cmake_params, "build_type": build_type},
+                          **self.profile_inputs(label), **self.install_inputs(label))
+            cached = self.cache_lookup(inputs)
+            if cached is not None:
+                return cached
+            prefix_dir = self.cache_prefix(inputs)
+
+        work_dir = self.work_path(source_dir)
+        prefix_base_dir = self.prefix_path(source_dir)
+        if url is not None:
+            source_dir = self.fetch_source(url, label, source_dir, extract_include, extract_exclude)
+
+        prefix_dir = check_prefix_dif(prefix_dir, prefix_base_dir, reuse=self.incremental,
+                                      name="prefix" + self.profile_suffix())
+        build_dir = check_build_dir(build_dir, work_dir, reuse=self.incremental or "pgo-use" in self.profile,
+                                    name=self.build_name(inputs))
+
+        profile = self.profile_flags(label)
+        profile_params = []
+        if profile["flags"]:
+            for variable in ("CMAKE_C_FLAGS", "CMAKE_CXX_FLAGS"):
+                profile_params += ["-D", "{}={}".format(variable, " ".join(profile["flags"]))]
+        if profile["ldflags"]:
+            for variable in ("CMAKE_EXE_LINKER_FLAGS", "CMAKE_SHARED_LINKER_FLAGS", "CMAKE_MODULE_LINKER_FLAGS"):
+                profile_params += ["-D", "{}={}".format(variable, " ".join(profile["ldflags"]))]
+        for variable, value in sorted(profile["cmake"].items()):
+            if variable == "CMAKE_BUILD_TYPE":
+                build_type = value
+            else:
+                profile_params += ["-D", "{}={}".format(variable, value)]
+
+        launcher_params = []
+        if self.compiler_launcher is not None:
+            launcher_params = ["-D", "CMAKE_C_COMPILER_LAUNCHER={}".format(self.compiler_launcher),
+                               "-D", "CMAKE_CXX_COMPILER_LAUNCHER={}".format(self.compiler_launcher)]
+
+        # paths are passed as single arguments, they may contain spaces or (on Windows) backslashes
+        configure_command = ([self.cmake_binary,
+                              "-S", source_dir,
+                              "-B", build_dir,
+                              "-G", "Ninja",
+                              "-D", "CMAKE_MAKE_PROGRAM={}".format(self.ninja_binary),
+                              "-D", "CMAKE_INSTALL_PREFIX={}".format(prefix_dir),
+                              "-D", "CMAKE_BUILD_TYPE={}".format(build_type),
+                              "-D", "CMAKE_C_COMPILER={}".format(self.c_compiler),
+                              "-D", "CMAKE_CXX_COMPILER={}".format(self.cxx_compiler)] +
+                             launcher_params +
+                             profile_params +
+                             split_params(cmake_params))
+        if not self.configured(build_dir, configure_command):
+            with phase("configure"):
+                execute_command(configure_command, env=self.environment())
+            self.mark_configured(build_dir, configure_command)
+
+        with phase("compile"), self.job_slots():
+            execute_command([self.cmake_binary, "--build", build_dir, "--target", "all", "--parallel", self.jobs],
+                            env=self.environment())
+        components = self.install_policy(label)["components"]
+        with phase("install"):
+            if not components:
+                execute_command([self.cmake_binary, "--build", build_dir, "--target", "install"], env=self.environment())
+            for component in components:
+                execute_command([self.cmake_binary, "-D", "COMPONENT={}".format(component),
+                                 "-P", os.path.join(build_dir, "cmake_install.cmake")], env=self.environment())
+        self.trim_install(label, prefix_dir, components_installed=True)
+
+        if inputs is not None:
+            self.cache_store(inputs, prefix_dir)
+        return prefix_dir
+
+
+    """Configure project with configure script, build and install with make; return installation prefix.
+
+    The archive and the build cache are handled the same way as in build_cmake.
+    """
+    def build_make(self, source_dir, configure_params=None,
+                   prefix_dir=None, prefix_arg="--prefix=", build_dir=None, url=None, label="temp",
+                   extract_include=None, extract_exclude=None):
 
         if configure_params is None:
             configure_params = ""
 
-        configure_script = os.path.join(os.path.abspath(source_dir), "configure")
-        os.chdir(build_dir)
-        execute_command("{} ".format(configure_script) +
-                        "{}{} ".format(prefix_arg, prefix_dir) +
-                        "{} ".format(configure_params))
-        execute_command("make")
-        execute_command("make install")
-        os.chdir(current_dir)
+        inputs = None
+        if url is not None and prefix_dir is None and self.cache_dir is not None:
+            inputs = dict({"backend": "make", "url": url, "configure_params": configure_params, "prefix_arg": prefix_arg},
+                          **self.profile_inputs(label), **self.install_inputs(label))
+            cached = self.cache_lookup(inputs)
+            if cached is not None:
+                return cached
+            prefix_dir = self.cache_prefix(inputs)
+
+        work_dir = self.work_path(source_dir)
+        prefix_base_dir = self.prefix_path(source_dir)
+        if url is not None:
+            source_dir = self.fetch_source(url, label, source_dir, extract_include, extract_exclude)
+
+        prefix_dir = check_prefix_dif(prefix_dir, prefix_base_dir, reuse=self.incremental,
+                                      name="prefix" + self.profile_suffix())
+        build_dir = check_build_dir(build_dir, work_dir, reuse=self.incremental or "pgo-use" in self.profile,
+                                    name=self.build_name(inputs))
+
+        # configure scripts take the flags of the build profile from the environment
+        profile = self.profile_flags(label)
+        flags = dict()
+        if profile["flags"]:
+            flags["CFLAGS"] = flags["CXXFLAGS"] = " ".join(profile["flags"])
+        if profile["ldflags"]:
+            flags["LDFLAGS"] = " ".join(profile["ldflags"])
 
+        configure_script = os.path.join(os.path.abspath(source_dir), "configure")
+        env = self.environment(CC=self.launched(self.c_compiler), CXX=self.launched(self.cxx_compiler), **flags)
+        # "--prefix=" is joined with the directory, "-prefix " is an argument of its own
+        prefix_params = ["{}{}".format(prefix_arg, prefix_dir)]
+        if prefix_arg.endswith(" "):
+            prefix_params = [prefix_arg.strip(), prefix_dir]
+        configure_command = [configure_script] + prefix_params + split_params(configure_params)
+        configure_stamp = configure_command + [env["CC"], env["CXX"], json.dumps(flags, sort_keys=True)]
+        if not self.configured(build_dir, configure_stamp):
+            with phase("configure"):
+                execute_command(configure_command, cwd=build_dir, env=env)
+            self.mark_configured(build_dir, configure_stamp)
+        with phase("compile"):
+            self.run_make(cwd=build_dir)
+        with phase("install"):
+            execute_command(["make", "install"], cwd=build_dir, env=self.environment())
+        self.trim_install(label, prefix_dir)
+
+        if inputs is not None:
+            self.cache_store(inputs, prefix_dir)
         return prefix_dir
 
 
-    """Download CMake and store cmake executable path as cmake_binary class member."""
-    def download_cmake(self, version="3.21.1"):
+    """Return URL of CMake archive and relative path of cmake executable in the extracted archive."""
+    def cmake_archive(self, version="3.21.1"):
         if self.platform == "Linux":
             suffix = "Linux-x86_64.tar.gz"
             dirname = "cmake-{}-linux-x86_64".format(version)
-            self.cmake_binary = os.path.join(dirname, "bin", "cmake")
+            cmake_binary = os.path.join(dirname, "bin", "cmake")
         elif self.platform == "macOS":
             suffix = "Darwin-x86_64.tar.gz"
             dirname = "cmake-{}-Darwin-x86_64".format(version)
-            self.cmake_binary = os.path.join(dirname, "CMake.app", "Contents", "bin", "cmake")
+            cmake_binary = os.path.join(dirname, "CMake.app", "Contents", "bin", "cmake")
         elif self.platform == "Windows":
             suffix = "win64-x64.zip"
             dirname = "cmake-{}-win64-x64".format(version)
-            self.cmake_binary = os.path.join(dirname, "bin", "cmake.exe")
+            cmake_binary = os.path.join(dirname, "bin", "cmake.exe")
         else:
             raise RuntimeError("Unknown platform {}".format(self.platform))
 
         url = "https://github.com/Kitware/CMake/releases/download/v{}/cmake-{}-{}".format(version, version, suffix)
-        download_and_extract_archive(url=url, label="cmake")
-        self.cmake_binary = os.path.abspath(self.cmake_binary)
+        return url, cmake_binary
+
+
+    """Hold job slots of the shared jobserver while a build tool other than make runs self.jobs jobs.
+
+    One of the jobs runs in the implicit slot of the tool, like the first job of make. Without a
+    jobserver nothing is held.
+    """
+    @contextlib.contextmanager
+    def job_slots(self):
+        if self.jobserver is None:
+            yield
+            return
+        slots = max(self.jobs - 1, 0)
+        self.jobserver.acquire(slots)
+        try:
+            yield
+        finally:
+            self.jobserver.release(slots)
+
+
+    """Run make in cwd with self.jobs parallel jobs, or with the job slots of the shared jobserver if there is one."""
+    def run_make(self, cwd, target=None):
+        cmd = ["make"] if target is None else ["make", target]
+        if self.jobserver is None:
+            execute_command(cmd + ["-j{}".format(self.jobs)], cwd=cwd, env=self.environment())
+        else:
+            env = self.environment(MAKEFLAGS=self.jobserver.makeflags())
+            execute_command(cmd, cwd=cwd, env=env,
+                            pass_fds=(self.jobserver.read_fd, self.jobserver.write_fd))
+
 
+    """Return path of the tool (cmake or ninja) executable whose version is at least minimum_version.
 
-    """Download Ninja build tools and store ninja executable path as ninja_binary class member."""
-    def download_ninja(self, version="1.10.2"):
+    The tool is looked up on PATH and in the tool cache. If neither is suitable, the given version
+    is downloaded into <tool_cache_dir>/<tool>-<version>-<platform> (unless download is False, then
+    None is returned); the cache may be shared by several workspaces running at the same time.
+    """
+    def find_tool(self, tool, version=None, minimum_version=None, download=True):
+        default_version, default_minimum_version = TOOL_VERSIONS[tool]
+        version = version or default_version
+        minimum_version = tuple(int(number) for number in (minimum_version or default_minimum_version).split("."))
+        url, relative_binary = getattr(self, tool + "_archive")(version)
+        tool_dir = os.path.join(self.tool_cache_dir, "{}-{}-{}".format(tool, version, self.platform))
+        cached_binary = os.path.join(tool_dir, relative_binary)
+
+        for binary in (shutil.which(tool), cached_binary):
+            if binary is not None and os.path.isfile(binary):
+                binary_version = tool_version(binary)
+                if binary_version is not None and binary_version >= minimum_version:
+                    print("Using {} {}".format(binary, ".".join(str(number) for number in binary_version)))
+                    return os.path.abspath(binary)
+        if not download:
+            return None
+
+        os.makedirs(self.tool_cache_dir, exist_ok=True)
+        with file_lock(tool_dir + ".lock"):
+            # another workspace may have installed it while we waited
+            if not os.path.isfile(cached_binary):
+                if os.path.isdir(tool_dir):
+                    shutil.rmtree(tool_dir)
+                temp_dir = tempfile.mkdtemp(prefix=os.path.basename(tool_dir) + ".", dir=self.tool_cache_dir)
+                try:
+                    self.download(url=url, label=tool, directory=temp_dir)
+                    os.replace(temp_dir, tool_dir)
+                except BaseException:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    raise
+        return cached_binary
+
+
+    """Find or download CMake and store cmake executable path as cmake_binary class member, see find_tool."""
+    def download_cmake(self, version=None, minimum_version=None):
+        self.cmake_binary = self.find_tool("cmake", version, minimum_version)
+
+
+    """Return URL of Ninja archive and relative path of ninja executable in the extracted archive."""
+    def ninja_archive(self, version="1.10.2"):
         if self.platform == "Linux":
             suffix = "linux.zip"
-            self.ninja_binary = "ninja"
+            ninja_binary = "ninja"
         elif self.platform == "macOS":
             suffix = "mac.zip"
-            self.ninja_binary = "ninja"
+            ninja_binary = "ninja"
         elif self.platform == "Windows":
             suffix = "win.zip"
-            self.ninja_binary = "ninja.exe"
+            ninja_binary = "ninja.exe"
         else:
             raise RuntimeError("Unknown platform {}".format(self.platform))
 
         url = "https://github.com/ninja-build/ninja/releases/download/v{}/ninja-{}".format(version, suffix)
-        download_and_extract_archive(url=url, label="ninja")
-        self.ninja_binary = os.path.abspath(self.ninja_binary)
+        return url, ninja_binary
+
+
+    """Find or download Ninja and store ninja executable path as ninja_binary class member, see find_tool."""
+    def download_ninja(self, version=None, minimum_version=None):
+        self.ninja_binary = self.find_tool("ninja", version, minimum_version)
+
+
+    """Build the recipe and stage its prefix into the sysroot if there is one.
+
+    The scratch directory of the recipe is removed when it succeeds and kept for debugging when it fails.
+    """
+    def build_recipe(self, label):
+        try:
+            with phase("recipe"):
+                getattr(self, RECIPES[label].method)()
+        except BaseException:
+            if self.recipe_scratch_dir is not None:
+                print("Keeping {} of failed {}".format(self.recipe_scratch_dir, self.recipe_key(label)))
+            raise
+        self.locked_inputs[label] = self.lock_entry(label)
+        if self.sysroot is not None:
+            with phase("stage"):
+                self.stage(label)
+        if self.recipe_scratch_dir is not None:
+            shutil.rmtree(self.recipe_scratch_dir)
+
+
+    """Run the recipe on a shallow copy of the builder limited to the given number of jobs.
+
+    The copy shares the prefixes dict, so the result is visible to the caller and to
+    recipes running concurrently. The output of the commands goes to <log_dir>/<label>.log,
+    and timeouts (self.timeouts by default) limit the phases.
+    """
+    def run_recipe(self, label, jobs=None, jobserver=None, timeouts=None):
+        worker = copy.copy(self)
+        if jobs is not None:
+            worker.jobs = jobs
+        if jobserver is not None:
+            worker.jobserver = jobserver
+        worker.recipe = label
+
+        tracing.events = self.timings
+        tracing.recipe = execution.recipe = self.recipe_key(label)
+        execution.timeouts = self.timeouts if timeouts is None else timeouts
+        execution.log = None
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            execution.log = os.path.join(self.log_dir, "{}.log".format(label))
+            open(execution.log, "w").close()
+        if self.scratch_dir is not None:
+            worker.recipe_scratch_dir = os.path.join(self.scratch_dir, self.recipe_key(label))
+            os.makedirs(worker.recipe_scratch_dir, exist_ok=True)
+        try:
+            if self.compiler_launcher is None:
+                worker.build_recipe(label)
+                return
+
+            # sccache has one server for all the recipes, so its statistics are exact only for sequential builds
+            sccache = os.path.basename(self.compiler_launcher).startswith("sccache")
+            if sccache:
+                before = worker.sccache_stats()
+            else:
+                log = worker.compiler_cache_log()
+                os.makedirs(os.path.dirname(log), exist_ok=True)
+                open(log, "w").close()
+
+            worker.build_recipe(label)
+        finally:
+            tracing.events = None
+            execution.recipe = execution.timeouts = execution.log = None
+
+        if sccache:
+            after = worker.sccache_stats()
+            stats = {key: after[key] - before[key] for key in after}
+        else:
+            with open(log) as log_file:
+                counters = [line.strip() for line in log_file if line.strip() and not line.startswith("#")]
+            stats = {"hits": sum("hit" in counter for counter in counters),
+                     "misses": sum("miss" in counter for counter in counters)}
+        self.compiler_cache_stats[label] = stats
+        print("Compiler cache for {}: {} hits, {} misses".format(self.recipe_key(label), stats["hits"], stats["misses"]))
+
+
+    """Stage the prefix of the built recipe into the sysroot and update its toolchain files.
+
+    Files identical to the ones staged by other prefixes are shared, different ones are a conflict
+    (RuntimeError). The recipes themselves keep using the prefixes of their dependencies, so the
+    build cache keys do not depend on what else is in the sysroot.
+    """
+    def stage(self, label):
+        key = RECIPES[label].prefix
+        prefix_dir = self.get_prefix(key)
+        print("Staging {} into {}...".format(prefix_dir, self.sysroot))
+        os.makedirs(self.sysroot, exist_ok=True)
+        with directory_lock(self.sysroot):
+            stage_prefix(prefix_dir, self.sysroot, key)
+            self.write_sysroot_files()
+        print("Done!")
+
+
+    """Write the toolchain files pointing consumers at the sysroot.
+
+    builder-toolchain.cmake is passed as CMAKE_TOOLCHAIN_FILE (or included from another one) and
+    env.sh is sourced by shells running make, pkg-config or the staged tools.
+    """
+    def write_sysroot_files(self):
+        pkg_config_path = ":".join(os.path.join(self.sysroot, directory, "pkgconfig")
+                                   for directory in ("lib", "lib64", "share"))
+        with open(os.path.join(self.sysroot, "builder-toolchain.cmake"), "w") as toolchain_file:
+            toolchain_file.write("# Generated by builder.py\n"
+                                 "set(CMAKE_C_COMPILER \"{}\")\n"
+                                 "set(CMAKE_CXX_COMPILER \"{}\")\n"
+                                 "set(CMAKE_PREFIX_PATH \"{}\" ${{CMAKE_PREFIX_PATH}})\n"
+                                 "set(ENV{{PKG_CONFIG_PATH}} \"{}:$ENV{{PKG_CONFIG_PATH}}\")\n".format(
+                                     self.c_compiler, self.cxx_compiler, self.sysroot, pkg_config_path))
+        with open(os.path.join(self.sysroot, "env.sh"), "w") as env_file:
+            env_file.write("# Generated by builder.py\n"
+                           "export CMAKE_PREFIX_PATH=\"{0}${{CMAKE_PREFIX_PATH:+:$CMAKE_PREFIX_PATH}}\"\n"
+                           "export PKG_CONFIG_PATH=\"{1}${{PKG_CONFIG_PATH:+:$PKG_CONFIG_PATH}}\"\n"
+                           "export PATH=\"{0}/bin:$PATH\"\n"
+                           "export LD_LIBRARY_PATH=\"{0}/lib:{0}/lib64${{LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}}\"\n".format(
+                               self.sysroot, pkg_config_path))
+
+
+    """Return the resolved inputs of the recipe in the current configuration.
+
+    The entry has the version, URL and pinned checksum of the archive, the hash of the source of the
+    recipe method (its parameters), the compiler identities, the build profile and install policy
+    inputs and, in "deps", lock_digest of the entry of every dependency, so a change upstream
+    changes the entries of all the recipes downstream.
+    """
+    def lock_entry(self, label):
+        method = getattr(Builder, RECIPES[label].method)
+        return {"version": recipe_version(label),
+                "url": recipe_url(label),
+                "checksum": self.checksums.get(label),
+                "recipe": hashlib.sha256(inspect.getsource(method).encode()).hexdigest()[:16],
+                "c_compiler": compiler_identity(self.c_compiler),
+                "cxx_compiler": compiler_identity(self.cxx_compiler),
+                "profile": self.profile_inputs(label),
+                "install": self.install_policy(label),
+                "deps": {dep: lock_digest(self.lock_entry(dep)) for dep in RECIPES[label].deps}}
+
+
+    """Write the lock entries of the recipes built by run_recipe with their prefixes to the lockfile.
+
+    Entries of other recipes that are still built are kept, so the lockfile describes all the
+    prefixes; concurrent writers wait for each other.
+    """
+    def write_lockfile(self, filename):
+        with file_lock(filename + ".lock"):
+            recipes = read_lockfile(filename)
+            for label, entry in self.locked_inputs.items():
+                recipes[label] = dict(entry, prefix=self.get_prefix(RECIPES[label].prefix))
+            recipes = {label: entry for label, entry in recipes.items()
+                       if label in RECIPES and RECIPES[label].prefix in self.prefixes}
+            with open(filename + ".tmp", "w") as lockfile:
+                json.dump({"recipes": recipes}, lockfile, indent=4, sort_keys=True)
+            os.replace(filename + ".tmp", filename)
+
+
+    """Return the recipes (with their dependencies) to build again, compared to the lockfile.
+
+    The result is a list of (label, reasons) in build order: recipes whose lock entry differs from
+    the locked one or whose locked prefix is missing, and everything downstream of them, including
+    the recipes of the lockfile that were not asked for but depend on them.
+    """
+    def plan_changes(self, labels, filename):
+        locked = read_lockfile(filename)
+        requested = resolve_recipes(labels)
+        locked_labels = [label for label in locked if label in RECIPES and label not in requested]
+        dependents = [label for label in locked_labels
+                      if any(label in dependent_recipes(dep, [label]) for dep in requested)]
+        changes = []
+        for label in resolve_recipes(requested + dependents):
+            rebuilt = [changed for changed, changed_reasons in changes]
+            if label not in requested and not any(dep in rebuilt for dep in RECIPES[label].deps):
+                # recipes not asked for are only reported as the dependents of the rebuilt ones
+                continue
+            entry = self.lock_entry(label)
+            old = locked.get(label)
+            if old is None:
+                changes.append((label, ["not in {}".format(filename)]))
+                continue
+
+            reasons = ["{} changed from {} to {}".format(key, json.dumps(old.get(key), sort_keys=True),
+                                                         json.dumps(entry[key], sort_keys=True))
+                       for key in sorted(entry) if key != "deps" and old.get(key) != entry[key]]
+            reasons += ["dependency {} changed".format(dep) for dep in sorted(entry["deps"])
+                        if dep not in rebuilt and old.get("deps", dict()).get(dep) != entry["deps"][dep]]
+            reasons += ["dependency {} is rebuilt".format(dep) for dep in RECIPES[label].deps if dep in rebuilt]
+            if not os.path.isdir(old.get("prefix") or ""):
+                reasons.append("prefix {} is missing".format(old.get("prefix")))
+            if reasons:
+                changes.append((label, reasons))
+        return changes
+
+
+    """Export artifacts of the built recipes whose prefixes are in the build cache."""
+    def export_artifacts(self, labels):
+        for label in labels:
+            prefix_dir = self.get_prefix(RECIPES[label].prefix)
+            if os.path.dirname(os.path.dirname(prefix_dir)) != self.cache_dir:
+                print("{} is not in the build cache, skipping".format(label))
+                continue
+            self.export_artifact(os.path.basename(os.path.dirname(prefix_dir)))
+
+
+    """Write phases of the built recipes to JSON file.
+
+    Every phase has recipe label, phase name (download, extract, configure, compile,
+    install, trim, stage or recipe for the whole recipe), start time and duration in seconds,
+    thread identifier, CPU time of the commands in seconds and peak RSS of the
+    biggest command in bytes.
+    """
+    def write_timings(self, filename):
+        with open(filename, "w") as timings_file:
+            json.dump(sorted(self.timings, key=lambda event: event["start"]), timings_file, indent=4)
+
+
+    """Write phases of the built recipes to Chrome trace file (chrome://tracing or ui.perfetto.dev), one track per recipe."""
+    def write_trace(self, filename):
+        recipes = sorted(set(event["recipe"] for event in self.timings))
+        trace = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": recipe}}
+                 for tid, recipe in enumerate(recipes)]
+        for event in self.timings:
+            trace.append({"name": event["recipe"] if event["phase"] == "recipe" else event["phase"],
+                          "cat": event["recipe"], "ph": "X", "pid": 1,
+                          "tid": recipes.index(event["recipe"]),
+                          "ts": int(event["start"] * 1e6), "dur": int(event["duration"] * 1e6),
+                          "args": {"cpu_time": event["cpu_time"], "max_rss": event["max_rss"]}})
+        with open(filename, "w") as trace_file:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, trace_file)
+
+
+    """Return labels of the recipes that build_recipes would build, in dependency order."""
+    def plan_recipes(self, labels, force=False):
+        return [label for label in resolve_recipes(labels)
+                if (force and label in labels) or RECIPES[label].prefix not in self.prefixes]
+
+
+    """Print what build_recipes would do without doing it."""
+    def print_plan(self, labels, force=False):
+        pending = self.plan_recipes(labels, force)
+        for tool in ("cmake", "ninja"):
+            if pending and getattr(self, tool + "_binary", None) is None:
+                # find_tool prints the tool found on PATH or in the tool cache
+                if self.find_tool(tool, download=False) is None:
+                    print("{}: download".format(tool))
+        for label in resolve_recipes(labels):
+            recipe = RECIPES[label]
+            if label not in pending:
+                print("{}: already built in {}".format(label, self.prefixes[recipe.prefix]))
+                continue
+            deps = [dep for dep in recipe.deps if dep in pending]
+            print("{}: build {} from {}{}".format(label, recipe_version(label), recipe_url(label),
+                                                  ", after " + ", ".join(deps) if deps else ""))
+
+
+    """Return the expected cost of each of the labels (in dependency order) for sharing the jobs.
+
+    The cost is the duration of the last build of the recipe (the mean of the known ones if it was
+    never built) plus the cost of the costliest of the labels waiting for it, so that the recipes
+    on the critical path get more jobs.
+    """
+    def expected_costs(self, labels):
+        known = list(self.recipe_durations.values())
+        default = sum(known) / len(known) if known else 1.0
+        costs = dict()
+        for label in reversed(labels):
+            dependents = [costs[other] for other in costs if label in RECIPES[other].deps]
+            costs[label] = self.recipe_durations.get(self.recipe_key(label), default) + max(dependents, default=0.0)
+        return costs
+
+
+    """Build the recipes and the dependencies that are not built yet, running independent ones in parallel.
+
+    The total budget of jobs (self.jobs by default) is split between the recipes
+    starting at the same time in proportion to their expected costs. CMake and Ninja are
+    downloaded first if needed. With prefetch, all archives are downloaded in the background
+    from the start and each recipe waits only for its own archive. Recipes that are already built
+    are skipped unless force is set (then the requested ones are rebuilt). On POSIX systems
+    make-based recipes share one jobserver for the whole budget, so their jobs are balanced
+    between them; Ninja and b2 run their share of the budget with job slots taken from the
+    jobserver, so make gets only the rest meanwhile. Return the critical path as
+    a list of recipe labels. on_done is called with the label of every recipe built
+    successfully, e.g. to save the state right away. When a recipe fails, the recipes depending
+    on it are cancelled, and the others are handled according to on_failure (self.on_failure
+    by default, see the class members). timeouts are added to self.timeouts. On Linux a ResourceMonitor keeps the
+    builds under memory_limit (self.memory_limit by default).
+    """
+    def build_recipes(self, labels, jobs=None, prefetch=True, on_done=None, force=False, memory_limit=None,
+                      on_failure=None, timeouts=None):
+        if jobs is None:
+            jobs = self.jobs
+        if memory_limit is None:
+            memory_limit = self.memory_limit
+        if on_failure is None:
+            on_failure = self.on_failure
+        timeouts = dict(self.timeouts, **(timeouts or dict()))
+
+        pending = self.plan_recipes(labels, force)
+        if not pending:
+            print("Nothing to build")
+            return []
+
+        # recipes taken from the build cache need neither their archives nor the tools
+        cached = self.cached_recipes(pending)
+        tools = [tool for tool in ("cmake", "ninja") if getattr(self, tool + "_binary", None) is None]
+        if len(cached) == len(pending):
+            tools = []
+        for tool in list(tools):
+            # only the tools that are neither on PATH nor in the tool cache are prefetched
+            binary = self.find_tool(tool, download=False)
+            if binary is not None:
+                setattr(self, tool + "_binary", binary)
+                tools.remove(tool)
+        if prefetch:
+            self.prefetch([label for label in pending if label not in cached], tools)
+        if "cmake" in tools:
+            self.download_cmake()
+        if "ninja" in tools:
+            self.download_ninja()
+
+        jobserver = JobServer(jobs) if os.name == "posix" else None
+        monitor = None
+        if os.path.isfile("/proc/meminfo"):
+            monitor = ResourceMonitor(memory_limit, jobserver)
+        running = dict()
+        started = dict()
+        durations = dict()
+        failed = []
+        cancelled = []
+        start_time = time.monotonic()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(pending), 1)) as pool:
+            try:
+                while running or (pending and (not failed or on_failure == "keep-going")):
+                    busy = [label for label, _ in running.values()]
+                    ready = [label for label in pending
+                             if all(dep not in pending and dep not in busy for dep in RECIPES[label].deps)]
+                    free = jobs - sum(share for _, share in running.values())
+                    held = monitor is not None and monitor.throttling() and running
+                    starting = not failed or on_failure == "keep-going"
+                    if ready and starting and (free > 0 or not running) and not held:
+                        costs = self.expected_costs(pending)
+                        ready = sorted(ready, key=costs.get, reverse=True)[:max(free, 1)]
+                        shares = job_shares(max(free, 1), {label: costs[label] for label in ready})
+                        for label in ready:
+                            share = shares[label]
+                            print("Starting {} with {} jobs...".format(self.recipe_key(label), share))
+                            pending.remove(label)
+                            started[label] = time.monotonic()
+                            running[pool.submit(self.run_recipe, label, share, jobserver, timeouts)] = (label, share)
+
+                    if not running:
+                        break
+
+                    # held recipes are started as soon as the monitor stops throttling
+                    timeout = monitor.interval if ready and held else None
+                    done, _ = concurrent.futures.wait(running, timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        label, _ = running.pop(future)
+                        durations[label] = time.monotonic() - started[label]
+                        if future.exception() is None:
+                            if label in cancelled:
+                                cancelled.remove(label)
+                            print("Done {} in {:.1f}s".format(self.recipe_key(label), durations[label]))
+                            if label not in cached:
+                                self.recipe_durations[self.recipe_key(label)] = durations[label]
+                            if on_done is not None:
+                                on_done(label)
+                            continue
+
+                        if label in cancelled:
+                            print("Killed {} after {:.1f}s".format(self.recipe_key(label), durations[label]))
+                            continue
+                        print("Failed {} after {:.1f}s: {}".format(self.recipe_key(label), durations[label], future.exception()))
+                        if self.log_dir is not None:
+                            print(log_tail(os.path.join(self.log_dir, "{}.log".format(label))), end="")
+                        failed.append(label)
+
+                        for dependent in dependent_recipes(label, pending):
+                            print("Cancelled {}, it depends on {}".format(self.recipe_key(dependent), label))
+                            pending.remove(dependent)
+                            cancelled.append(dependent)
+                        if on_failure == "kill" and running:
+                            killed = [label for label, _ in running.values()]
+                            print("Killing {}".format(", ".join(self.recipe_key(label) for label in killed)))
+                            cancelled.extend(killed)
+                            cancel_recipes([self.recipe_key(label) for label in killed])
+            except BaseException:
+                # e.g. KeyboardInterrupt, the commands run in their own sessions and would not get it
+                cancel_recipes([self.recipe_key(label) for label, _ in running.values()])
+                raise
+            finally:
+                if monitor is not None:
+                    monitor.close()
+
+        with processes_lock:
+            cancelled_recipes.difference_update(self.recipe_key(label) for label in cancelled)
+        if jobserver is not None:
+            jobserver.close()
+
+        if failed:
+            raise RuntimeError("Failed recipes: {}; cancelled: {}; not started: {}".format(
+                ", ".join(failed), ", ".join(cancelled) or "none", ", ".join(pending) or "none"))
+
+        path = critical_path(durations)
+        print("Critical path: {} ({:.1f}s of {:.1f}s wall clock)".format(
+            " -> ".join("{} ({:.1f}s)".format(self.recipe_key(label), durations[label]) for label in path),
+            sum(durations[label] for label in path), time.monotonic() - start_time))
+        return path
 
 
     def get_prefix(self, key):
@@ -202,28 +2571,27 @@ class Builder:
 
 
     def build_yaml_cpp(self, version="0.6.3", prefix_dir=None):
-        url = "https://github.com/jbeder/yaml-cpp/archive/yaml-cpp-{}.tar.gz".format(version)
-        download_and_extract_archive(url=url, label="yaml_cpp")
+        url = recipe_url("yaml_cpp", version)
 
         source_dir = "yaml-cpp-yaml-cpp-{}".format(version)
         self.prefixes['yaml-cpp'] = self.build_cmake(source_dir=source_dir,
                                                      cmake_params="-D YAML_BUILD_SHARED_LIBS=ON "
                                                                   "-D YAML_CPP_BUILD_TESTS=OFF ",
-                                                     prefix_dir=prefix_dir)
+                                                     prefix_dir=prefix_dir,
+                                                     url=url, label="yaml_cpp")
 
 
     def build_date(self, version="3.0.0", prefix_dir=None):
-        url = "https://github.com/HowardHinnant/date/archive/v{}.tar.gz".format(version)
-        download_and_extract_archive(url=url, label="date")
+        url = recipe_url("date", version)
 
         source_dir = "date-{}".format(version)
         self.prefixes['date'] = self.build_cmake(source_dir=source_dir,
-                                                 prefix_dir=prefix_dir)
+                                                 prefix_dir=prefix_dir,
+                                                 url=url, label="date")
 
 
     def build_sqlpp11(self, version="0.60", prefix_dir=None):
-        url = "https://github.com/rbock/sqlpp11/archive/{}.tar.gz".format(version)
-        download_and_extract_archive(url=url, label="sqlpp11")
+        url = recipe_url("sqlpp11", version)
 
         date_prefix = self.get_prefix("date")
 
@@ -232,12 +2600,12 @@ class Builder:
                                                     cmake_params="-D BUILD_TESTING=OFF " +
                                                                  "-D USE_SYSTEM_DATE=TRUE "
                                                                  "-D CMAKE_PREFIX_PATH=\"{}\" ".format(date_prefix),
-                                                    prefix_dir=prefix_dir)
+                                                    prefix_dir=prefix_dir,
+                                                    url=url, label="sqlpp11")
 
 
     def build_sqlpp11_mysql(self, version="0.30", prefix_dir=None):
-        url = "https://github.com/kovdan01/sqlpp11-connector-mysql/archive/refs/tags/{}.tar.gz".format(version)
-        download_and_extract_archive(url=url, label="sqlpp11_mysql")
+        url = recipe_url("sqlpp11_mysql", version)
 
         sqlpp11_prefix = self.get_prefix("sqlpp11")
         date_prefix = self.get_prefix("date")
@@ -248,72 +2616,192 @@ class Builder:
                                                                        "-D USE_MARIADB=TRUE " +
                                                                        "-D BUILD_SHARED_LIBS=TRUE " +
                                                                        "-D CMAKE_PREFIX_PATH=\"{};{}\" ".format(sqlpp11_prefix, date_prefix),
-                                                          prefix_dir=prefix_dir)
+                                                          prefix_dir=prefix_dir,
+                                                          url=url, label="sqlpp11_mysql")
 
 
     def build_catch2(self, version="2.13.4", prefix_dir=None):
-        url = "https://github.com/catchorg/Catch2/archive/v{}.tar.gz".format(version)
-        download_and_extract_archive(url=url, label="catch2")
+        url = recipe_url("catch2", version)
 
         source_dir = "Catch2-{}".format(version)
         self.prefixes['catch2'] = self.build_cmake(source_dir=source_dir,
                                                    cmake_params="-D BUILD_TESTING=OFF ",
-                                                   prefix_dir=prefix_dir)
+                                                   prefix_dir=prefix_dir,
+                                                   url=url, label="catch2")
 
 
-    def build_boost(self, version="1.76.0", prefix_dir=None):
-        current_dir = os.getcwd()
+    """Build Boost with b2 and install it.
 
+    libraries lists the compiled libraries to build (all but python by default), header_only installs
+    only the headers without building anything. link and variant may list several values, e.g.
+    link=("static", "shared"), that are built by one b2 run. The bootstrapped b2 engine is kept in
+    the cache directory for the compiler, so bootstrap.sh does not build it again.
+    """
+    def build_boost(self, version="1.76.0", prefix_dir=None, libraries=None, header_only=False,
+                    link=("shared",), variant=("release",)):
         version_major, version_minor, version_patch = version.split(".")
-        url = "https://boostorg.jfrog.io/artifactory/main/release/{}.{}.{}/source/boost_{}_{}_{}.tar.bz2".format(version_major, version_minor, version_patch,
-                                                                                                                 version_major, version_minor, version_patch)
-        download_and_extract_archive(url=url, label="boost")
+        url = recipe_url("boost", version)
+
+        if libraries is not None:
+            libraries = sorted(libraries)
+        link = list(link)
+        variant = list(variant)
+
+        inputs = None
+        if prefix_dir is None and self.cache_dir is not None:
+            if header_only:
+                inputs = dict({"backend": "boost", "url": url, "header_only": True}, **self.install_inputs("boost"))
+            else:
+                inputs = dict({"backend": "boost", "url": url, "libraries": libraries, "without_libraries": "python",
+                               "b2_params": "variant={} link={} threading=multi".format(",".join(variant), ",".join(link))},
+                              **self.profile_inputs("boost"), **self.install_inputs("boost"))
+            cached = self.cache_lookup(inputs)
+            if cached is not None:
+                self.prefixes['boost'] = cached
+                return
+            prefix_dir = self.cache_prefix(inputs)
 
         source_dir = "boost_{}_{}_{}".format(version_major, version_minor, version_patch)
-        prefix_dir = check_prefix_dif(prefix_dir, source_dir)
-
-        os.chdir(source_dir)
-
-        execute_command("chmod +x ./bootstrap.sh")
-        execute_command("chmod +x ./tools/build/src/engine/build.sh")
-
+        if header_only:
+            source_path = self.fetch_source(url, "boost", source_dir,
+                                            include=["boost_*/boost/**", "boost_*/LICENSE_1_0.txt"])
+            prefix_dir = check_prefix_dif(prefix_dir, self.prefix_path(source_dir), reuse=self.incremental)
+        else:
+            # documentation, examples and tests are most of the archive, but config checks include libs/config/test
+            source_path = self.fetch_source(url, "boost", source_dir, exclude=["boost_*/doc/**",
+                                                                               "boost_*/libs/*/doc/**",
+                                                                               "boost_*/libs/*/example/**",
+                                                                               "boost_*/libs/*/test/**",
+                                                                               "!boost_*/libs/config/test/**"])
+            prefix_dir = check_prefix_dif(prefix_dir, self.prefix_path(source_dir), reuse=self.incremental,
+                                          name="prefix" + self.profile_suffix())
+            # cflags, cxxflags and linkflags are free features that b2 leaves out of the object paths,
+            # so every build profile gets a build directory of its own, like the other backends
+            build_dir = check_build_dir(None, self.work_path(source_dir),
+                                        reuse=self.incremental or "pgo-use" in self.profile,
+                                        name=self.build_name(inputs))
+            # b2 runs in the source directory
+            source_dir = self.source_tree(source_dir, source_path)
+
+        if header_only:
+            with phase("install"):
+                include_dir = os.path.join(prefix_dir, "include")
+                os.makedirs(include_dir, exist_ok=True)
+                shutil.copytree(os.path.join(source_path, "boost"), os.path.join(include_dir, "boost"),
+                                dirs_exist_ok=True)
+            self.trim_install("boost", prefix_dir)
+            if inputs is not None:
+                self.cache_store(inputs, prefix_dir)
+            self.prefixes['boost'] = prefix_dir
+            return
+
+        # b2 keeps objects of different toolsets apart, so the source directory is never cleaned
         toolset = os.path.basename(self.c_compiler)
-        execute_command('echo "using {} : : {} : ;" > user-config.jam'.format(toolset, self.cxx_compiler))
-
-        execute_command("./bootstrap.sh " +
-                        "--with-toolset={} ".format(toolset) +
-                        "--without-libraries=python")
-
-        execute_command('./b2 ' +
-                        '--ignore-site-config ' +
-                        '--user-config=./user-config.jam ' +
-                        '--prefix={} '.format(prefix_dir) +
-                        'toolset={} '.format(toolset) +
-                        'variant=release ' +
-                        'link=shared ' +
-                        'threading=multi ' +
-                        'install')
-
-        os.chdir(current_dir)
+        user_config = "using {} : : {} : ;\n".format(toolset, " ".join(
+            '"{}"'.format(part) for part in self.launched(self.cxx_compiler).split()))
+        bootstrap_command = ["./bootstrap.sh", "--with-toolset={}".format(toolset)]
+        # b2 refuses --with-<library> options together with --without-libraries from project-config.jam
+        if libraries is None:
+            bootstrap_command += ["--without-libraries=python"]
+
+        engine = None
+        if self.cache_dir is not None:
+            engine = os.path.join(self.cache_dir, "b2-{}".format(self.cache_key({"backend": "b2", "url": url})), "b2")
+            if os.path.isfile(engine):
+                bootstrap_command += ["--with-bjam=./b2"]
+
+        if not self.configured(source_dir, bootstrap_command + [user_config], separate_build_dir=False):
+            with phase("configure"):
+                execute_command(["chmod", "+x", "./bootstrap.sh"], cwd=source_dir)
+                execute_command(["chmod", "+x", "./tools/build/src/engine/build.sh"], cwd=source_dir)
+
+                # unlinked first, a source tree of hardlinks must not change the source store
+                if os.path.lexists(os.path.join(source_dir, "user-config.jam")):
+                    os.remove(os.path.join(source_dir, "user-config.jam"))
+                with open(os.path.join(source_dir, "user-config.jam"), "w") as user_config_file:
+                    user_config_file.write(user_config)
+
+                if engine is not None and os.path.isfile(engine):
+                    print("Using cached b2 engine {}".format(engine))
+                    shutil.copy2(engine, os.path.join(source_dir, "b2"))
+                execute_command(bootstrap_command, cwd=source_dir)
+
+                if engine is not None and not os.path.isfile(engine):
+                    os.makedirs(os.path.dirname(engine), exist_ok=True)
+                    shutil.copy2(os.path.join(source_dir, "b2"), engine + ".tmp")
+                    os.replace(engine + ".tmp", engine)
+            self.mark_configured(source_dir, bootstrap_command + [user_config])
+
+        library_params = []
+        if libraries is not None:
+            library_params = ["--with-{}".format(library) for library in libraries]
+
+        profile = self.profile_flags("boost")
+        profile_params = ["{}={}".format(feature, flag)
+                          for flag in profile["flags"] for feature in ("cflags", "cxxflags")]
+        profile_params += ["linkflags={}".format(flag) for flag in profile["ldflags"]]
+        profile_params += list(profile["b2"])
+
+        # with the default system layout several variants would install libraries with the same names
+        layout_params = []
+        if len(variant) > 1:
+            layout_params = ["--layout=tagged"]
+
+        # pgo-use builds in the build directory of pgo-generate, whose objects b2 would consider up to date
+        rebuild_params = []
+        if "pgo-use" in self.profile:
+            rebuild_params = ["-a"]
+
+        # b2 builds and installs in one go
+        with phase("compile+install"), self.job_slots():
+            execute_command(["./b2",
+                             "-j{}".format(self.jobs),
+                             "--ignore-site-config",
+                             "--user-config=./user-config.jam",
+                             "--prefix={}".format(prefix_dir),
+                             "--build-dir={}".format(build_dir)] +
+                            rebuild_params +
+                            layout_params +
+                            library_params +
+                            profile_params +
+                            ["toolset={}".format(toolset),
+                             "variant={}".format(",".join(variant)),
+                             "link={}".format(",".join(link)),
+                             "threading=multi",
+                             "install"], cwd=source_dir, env=self.environment())
+        self.trim_install("boost", prefix_dir)
+
+        if inputs is not None:
+            self.cache_store(inputs, prefix_dir)
         self.prefixes['boost'] = prefix_dir
 
 
     def build_cyrus_sasl(self, version="2.1.27", prefix_dir=None):
-        url = "https://github.com/cyrusimap/cyrus-sasl/releases/download/cyrus-sasl-{}/cyrus-sasl-{}.tar.gz".format(version, version)
-        download_and_extract_archive(url=url, label="cyrus_sasl")
+        url = recipe_url("cyrus_sasl", version)
 
         source_dir = "cyrus-sasl-{}".format(version)
         self.prefixes['cyrus-sasl'] = self.build_make(source_dir=source_dir,
                                                       configure_params="--disable-otp " +
                                                                        "--with-dblib=gdbm ",
-                                                      prefix_dir=prefix_dir)
+                                                      prefix_dir=prefix_dir,
+                                                      url=url, label="cyrus_sasl")
 
 
     def build_qt5base(self, version="5.15.2", prefix_dir=None):
-        version_major, version_minor, version_patch = version.split(".")
-        version_short = "{}.{}".format(version_major, version_minor)
-        url = "http://download.qt.io/official_releases/qt/{}/{}/submodules/qtbase-everywhere-src-{}.tar.xz".format(version_short, version, version)
-        download_and_extract_archive(url=url, label="qt5base")
+        url = recipe_url("qt5base", version)
+
+        # Qt mkspecs ignore CC and CXX, the launcher is passed to qmake directly
+        qmake_compilers = ""
+        if self.compiler_launcher is not None:
+            qmake_compilers = "QMAKE_CC=\"{}\" QMAKE_CXX=\"{}\" ".format(self.launched("gcc"), self.launched("g++"))
+
+        # Qt configure ignores CFLAGS and LDFLAGS, the flags of the build profile are added to the mkspec
+        profile = self.profile_flags("qt5base")
+        profile_params = "".join("{} ".format(param) for param in profile["qmake"])
+        if profile["flags"]:
+            profile_params += "QMAKE_CFLAGS+={0} QMAKE_CXXFLAGS+={0} ".format(shlex.quote(" ".join(profile["flags"])))
+        if profile["ldflags"]:
+            profile_params += "QMAKE_LFLAGS+={} ".format(shlex.quote(" ".join(profile["ldflags"])))
 
         source_dir = "qtbase-everywhere-src-{}".format(version)
         self.prefixes['qt5base'] = self.build_make(source_dir=source_dir,
@@ -323,43 +2811,382 @@ class Builder:
                                                                     "-confirm-license " +
                                                                     "-no-opengl " +
                                                                     "-nomake examples " +
-                                                                    "-nomake tests ",
+                                                                    "-nomake tests " +
+                                                                    qmake_compilers +
+                                                                    profile_params,
                                                    prefix_dir=prefix_dir,
-                                                   prefix_arg="-prefix ")
+                                                   prefix_arg="-prefix ",
+                                                   url=url, label="qt5base",
+                                                   extract_exclude=["qtbase-everywhere-src-*/examples/**",
+                                                                    "qtbase-everywhere-src-*/tests/**"])
 
 
+    """Build qttools into its own prefix: a tree of hardlinks to the qt5base prefix with qttools on top.
+
+    Qt's CMake configs look for the tools next to the other Qt modules, so they need to be in one
+    prefix, but the qt5base prefix (e.g. its build cache entry) is left as it is. The result is taken
+    from the build cache only if the qt5base prefix itself comes from the cache.
+    """
     def build_qt5tools(self, version="5.15.2", prefix_dir=None):
-        version_major, version_minor, version_patch = version.split(".")
-        version_short = "{}.{}".format(version_major, version_minor)
-        url = "http://download.qt.io/official_releases/qt/{}/{}/submodules/qttools-everywhere-src-{}.tar.xz".format(version_short, version, version)
-        download_and_extract_archive(url=url, label="qt5base")
+        url = recipe_url("qt5tools", version)
+        qt5base_prefix = self.prefixes['qt5base']
+
+        inputs = None
+        if prefix_dir is None and self.cache_dir is not None and qt5base_prefix.startswith(self.cache_dir + os.sep):
+            inputs = dict({"backend": "qmake", "url": url, "qt5base": qt5base_prefix},
+                          **self.install_inputs("qt5tools"))
+            cached = self.cache_lookup(inputs)
+            if cached is not None:
+                self.prefixes['qt5tools'] = cached
+                return
+            prefix_dir = self.cache_prefix(inputs)
 
         source_dir = "qttools-everywhere-src-{}".format(version)
-
-        current_dir = os.getcwd()
-        os.chdir(source_dir)
-        execute_command("{}/bin/qmake qttools.pro".format(self.prefixes['qt5base']))
-        execute_command("make")
-        execute_command("make install")
-        os.chdir(current_dir)
-
-        self.prefixes['qt5tools'] = self.prefixes['qt5base']
+        source_path = self.fetch_source(url, "qt5tools", source_dir)
+        prefix_dir = check_prefix_dif(prefix_dir, self.prefix_path(source_dir), reuse=self.incremental,
+                                      name="prefix" + self.profile_suffix())
+        # qmake builds in the source directory
+        source_dir = self.source_tree(source_dir, source_path)
+
+        qmake_command = [os.path.join(self.prefixes['qt5base'], "bin", "qmake"), "qttools.pro"]
+        if not self.configured(source_dir, qmake_command, separate_build_dir=False):
+            with phase("configure"):
+                execute_command(qmake_command, cwd=source_dir, env=self.environment())
+            self.mark_configured(source_dir, qmake_command)
+        with phase("compile"):
+            self.run_make(cwd=source_dir)
+        with phase("install"):
+            # installed under INSTALL_ROOT first, qmake installs into the qt5base prefix
+            install_root = os.path.join(os.path.abspath(source_dir), "install-root")
+            if os.path.isdir(install_root):
+                shutil.rmtree(install_root)
+            execute_command(["make", "install", "INSTALL_ROOT={}".format(install_root)], cwd=source_dir,
+                            env=self.environment())
+            shutil.rmtree(prefix_dir)
+            link_tree(qt5base_prefix, prefix_dir)
+            installed = os.path.join(install_root, os.path.splitdrive(qt5base_prefix)[1].lstrip(os.sep))
+            for root, dirs, files in os.walk(installed):
+                target = os.path.join(prefix_dir, os.path.relpath(root, installed))
+                os.makedirs(target, exist_ok=True)
+                for name in dirs + files:
+                    if name in dirs and not os.path.islink(os.path.join(root, name)):
+                        continue
+                    if os.path.lexists(os.path.join(target, name)):
+                        os.remove(os.path.join(target, name))
+                    os.replace(os.path.join(root, name), os.path.join(target, name))
+            shutil.rmtree(install_root)
+            relocate_prefix(prefix_dir, [(qt5base_prefix, prefix_dir)])
+        self.trim_install("qt5tools", prefix_dir)
+
+        if inputs is not None:
+            self.cache_store(inputs, prefix_dir)
+        self.prefixes['qt5tools'] = prefix_dir
 
 
     def build_liboath(self, version="2.6.7", prefix_dir=None):
-        url = "https://download.savannah.nongnu.org/releases/oath-toolkit/oath-toolkit-{}.tar.gz".format(version)
-        download_and_extract_archive(url=url, label="oath-toolkit")
+        url = recipe_url("liboath", version)
 
         source_dir = os.path.join("oath-toolkit-{}".format(version), "liboath")
+        # liboath is a separate autoconf project, the rest of oath-toolkit is not extracted
         self.prefixes['liboath'] = self.build_make(source_dir=source_dir,
-                                                   prefix_dir=prefix_dir)
-
-
-def load_builder(filename="builder.pkl"):
-    with open(filename, "rb") as picklefile:
-        return pickle.load(picklefile)
-
-
-def save_builder(builder, filename="builder.pkl"):
-    with open(filename, 'wb') as picklefile:
-        pickle.dump(builder, picklefile)
+                                                   prefix_dir=prefix_dir,
+                                                   url=url, label="liboath",
+                                                   extract_include=["oath-toolkit-*/*",
+                                                                    "oath-toolkit-*/build-aux/**",
+                                                                    "oath-toolkit-*/liboath/**"])
+
+
+# Build the recipes for several toolchains at the same time (see Builder.toolchain_builder), splitting
+# the jobs between them. on_done is called with the builder and the label of every recipe built.
+def build_matrix(builders, labels, jobs=None, on_done=None, **kwargs):
+    if len(builders) == 1:
+        builder = builders[0]
+        builder.build_recipes(labels, jobs, on_done=None if on_done is None else functools.partial(on_done, builder),
+                              **kwargs)
+        return
+
+    if jobs is None:
+        jobs = builders[0].jobs
+
+    futures = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(builders)) as pool:
+        try:
+            for builder in builders:
+                builder_done = None if on_done is None else functools.partial(on_done, builder)
+                future = pool.submit(builder.build_recipes, labels, max(jobs // len(builders), 1),
+                                     on_done=builder_done, **kwargs)
+                futures[future] = builder
+            concurrent.futures.wait(futures)
+        except BaseException:
+            with processes_lock:
+                running = list(running_processes)
+            cancel_recipes(running)
+            raise
+
+    failed = []
+    for future, builder in futures.items():
+        if future.exception() is not None:
+            print("Toolchain {} failed: {}".format(builder.toolchain, future.exception()))
+            failed.append(builder.toolchain)
+    if failed:
+        raise RuntimeError("Failed toolchains: {}".format(", ".join(failed)))
+
+
+# builder.db -> builder-gcc.db
+def toolchain_filename(filename, toolchain):
+    root, extension = os.path.splitext(filename)
+    return "{}-{}{}".format(root, toolchain, extension)
+
+
+# Builder -> (settings, prefixes) as they were loaded, to save only what was changed since then
+loaded_states = weakref.WeakKeyDictionary()
+
+# Builder attributes that are not saved; jobs defaults to the CPU count of the machine running the build
+TRANSIENT_ATTRIBUTES = ("jobs", "jobserver", "recipe", "recipe_scratch_dir", "probing", "timings", "locked_inputs", "incremental")
+
+
+# Builder attribute -> environment variable that takes precedence over the saved setting
+ENVIRONMENT_SETTINGS = {
+    "compiler_launcher": "BUILDER_COMPILER_LAUNCHER",
+    "compiler_cache_dir": "BUILDER_COMPILER_CACHE_DIR",
+    "artifact_dir": "BUILDER_ARTIFACT_DIR",
+    "artifact_compression": "BUILDER_ARTIFACT_COMPRESSION",
+    "cache_dir": "BUILDER_CACHE_DIR",
+    "download_dir": "BUILDER_DOWNLOAD_DIR",
+    "tool_cache_dir": "BUILDER_TOOL_CACHE_DIR",
+    "memory_limit": "BUILDER_MEMORY_LIMIT",
+    "source_store": "BUILDER_SOURCE_STORE",
+    "work_dir": "BUILDER_WORK_DIR",
+    "scratch_dir": "BUILDER_SCRATCH_DIR",
+    "sysroot": "BUILDER_SYSROOT",
+    "profile": "BUILDER_PROFILE",
+    "profile_data_dir": "BUILDER_PROFILE_DATA_DIR",
+    "install_policies": "BUILDER_INSTALL_POLICIES",
+    "log_dir": "BUILDER_LOG_DIR",
+    "timeouts": "BUILDER_TIMEOUTS",
+    "on_failure": "BUILDER_ON_FAILURE",
+}
+
+
+def builder_settings(builder):
+    return {name: value for name, value in vars(builder).items()
+            if name != "prefixes" and name not in TRANSIENT_ATTRIBUTES}
+
+
+def load_builder(filename="builder.db"):
+    if not os.path.isfile(filename):
+        raise RuntimeError("Builder state {} does not exist, run init.py first".format(filename))
+    store = state.StateStore(filename)
+    try:
+        builder = Builder.__new__(Builder)
+        # defaults of the settings missing from older states and of the transient attributes
+        defaults = vars(Builder())
+        builder.__dict__.update(defaults)
+        builder.__dict__.update(store.get_settings())
+        builder.prefixes = store.get_prefixes()
+    finally:
+        store.close()
+
+    overrides = {name: defaults[name] for name, variable in ENVIRONMENT_SETTINGS.items() if variable in os.environ}
+    profile = overrides.pop("profile", None)
+    install_policies = overrides.pop("install_policies", None)
+    builder.__dict__.update(overrides)
+    if builder.artifact_dir is not None and builder.cache_dir is None:
+        # artifacts are restored into the build cache
+        builder.cache_dir = os.path.abspath("cache")
+    loaded_states[builder] = (json.loads(json.dumps(builder_settings(builder))), dict(builder.prefixes))
+
+    # like the run options, these make the prefixes built differently be built again
+    if profile is not None:
+        builder.set_profile(profile)
+    if install_policies is not None:
+        builder.set_install_policies(install_policies)
+    return builder
+
+
+# A loaded builder writes only settings and prefixes changed since it was loaded, so
+# concurrently running scripts don't overwrite each other's results. A new builder
+# replaces the whole state.
+def save_builder(builder, filename="builder.db"):
+    settings = json.loads(json.dumps(builder_settings(builder)))
+    prefixes = dict(builder.prefixes)
+    replace = builder not in loaded_states
+    if replace:
+        removed = []
+    else:
+        loaded_settings, loaded_prefixes = loaded_states[builder]
+        settings = {name: value for name, value in settings.items() if loaded_settings.get(name) != value}
+        removed = [label for label in loaded_prefixes if label not in prefixes]
+        prefixes = {label: prefix for label, prefix in prefixes.items() if loaded_prefixes.get(label) != prefix}
+
+    store = state.StateStore(filename)
+    try:
+        store.update(settings, prefixes, removed, replace=replace)
+    finally:
+        store.close()
+    loaded_states[builder] = (json.loads(json.dumps(builder_settings(builder))), dict(builder.prefixes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download, build and install C/C++ dependencies.")
+    parser.add_argument("--state", default="builder.db", help="builder state database (default: %(default)s)")
+    parser.add_argument("--lockfile", default="builder.lock",
+                        help="resolved inputs of the built recipes, written by run (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help="build recipes and the dependencies they need")
+    run_parser.add_argument("recipes", nargs="*", default=DEFAULT_RECIPES,
+                            help="recipes to build, one of {} (default: {})".format(
+                                ", ".join(RECIPES), " ".join(DEFAULT_RECIPES)))
+    run_parser.add_argument("-j", "--jobs", type=int, help="total number of parallel jobs")
+    run_parser.add_argument("--memory-limit", help="RSS ceiling of all the build processes, e.g. 8G")
+    run_parser.add_argument("--on-failure", choices=("finish", "keep-going", "kill"),
+                            help="what to do with independent recipes when one fails")
+    run_parser.add_argument("--timeout", action="append", default=[], metavar="PHASE=SECONDS",
+                            help="kill the commands of a phase (configure, compile, install, ...) running longer")
+    run_parser.add_argument("--force", action="store_true", help="rebuild requested recipes that are already built")
+    run_parser.add_argument("--no-prefetch", action="store_true", help="download archives only when needed")
+    run_parser.add_argument("--incremental", action="store_true",
+                            help="reuse sources and build directories of previous runs, e.g. after a failure")
+    run_parser.add_argument("--toolchain", action="append", default=[], metavar="NAME=CC,CXX",
+                            help="build for several toolchains at once, e.g. --toolchain gcc=gcc,g++ "
+                                 "--toolchain clang=clang,clang++; their states are kept in <state>-NAME files")
+    run_parser.add_argument("--profile", help="build profile, comma-separated names of {}; recipes built with "
+                                               "another profile are built again".format(", ".join(PROFILES)))
+    run_parser.add_argument("--strip", action="store_true", help="strip installed binaries")
+    run_parser.add_argument("--split-debug", action="store_true",
+                            help="move debug information of installed binaries to <prefix>.debug")
+    run_parser.add_argument("--install-component", action="append", default=[], metavar="RECIPE=COMPONENT",
+                            help="install only these components of a CMake recipe")
+    run_parser.add_argument("--install-exclude", action="append", default=[], metavar="[RECIPE=]PATTERN",
+                            help="remove matching paths from the installed prefixes (of the recipe), e.g. share/doc/**")
+    run_parser.add_argument("--install-everything", action="store_true",
+                            help="forget the install options of previous runs and install everything again")
+    run_parser.add_argument("--scratch-dir", help="extract and build in this directory, e.g. on tmpfs, removing "
+                                                   "the sources and build trees of every recipe that succeeds")
+    run_parser.add_argument("--sysroot", help="stage every built prefix into one directory with a CMake toolchain "
+                                               "file and env.sh pointing at it")
+    run_parser.add_argument("--dry-run", action="store_true", help="print the plan and exit")
+    run_parser.add_argument("--timings", help="write phase timings of the built recipes to JSON file")
+    run_parser.add_argument("--trace", help="write phase timings of the built recipes to Chrome trace file")
+
+    export_parser = subparsers.add_parser("export", help="pack prefixes of built recipes into the artifact directory")
+    export_parser.add_argument("recipes", nargs="*", help="recipes to export (default: all built ones)")
+
+    plan_parser = subparsers.add_parser("plan", help="print the recipes to build again because their inputs differ "
+                                                     "from the lockfile, and the recipes depending on them")
+    plan_parser.add_argument("recipes", nargs="*", default=DEFAULT_RECIPES,
+                             help="recipes to check (default: {})".format(" ".join(DEFAULT_RECIPES)))
+    plan_parser.add_argument("--compilers", metavar="CC,CXX", help="compilers to check instead of the current ones")
+    plan_parser.add_argument("--profile", help="build profile to check instead of the current one")
+    plan_parser.add_argument("--names", action="store_true",
+                             help="print only the recipe names, e.g. for \"run --force $(builder.py plan --names)\"")
+
+    sysroot_parser = subparsers.add_parser("sysroot", help="stage prefixes of built recipes into a merged sysroot")
+    sysroot_parser.add_argument("directory", nargs="?", help="sysroot directory (default: BUILDER_SYSROOT or the "
+                                                            "one of the last run)")
+    sysroot_parser.add_argument("--recipes", nargs="*", help="recipes to stage (default: all built ones)")
+
+    args = parser.parse_args()
+
+    if os.path.isfile(args.state):
+        builder = load_builder(args.state)
+    else:
+        builder = Builder()
+
+    if args.command == "run":
+        timeouts = dict()
+        for timeout in args.timeout:
+            name, seconds = timeout.split("=")
+            timeouts[name] = float(seconds)
+
+        install_policies = dict() if args.install_everything else None
+        if args.strip or args.split_debug or args.install_component or args.install_exclude:
+            install_policies = {"*": {"strip": args.strip, "split_debug": args.split_debug}}
+            for spec in args.install_component:
+                label, component = spec.split("=", 1)
+                install_policies.setdefault(label, dict()).setdefault("components", []).append(component)
+            for spec in args.install_exclude:
+                label, pattern = spec.split("=", 1) if spec.split("=", 1)[0] in RECIPES else ("*", spec)
+                install_policies.setdefault(label, dict()).setdefault("exclude", []).append(pattern)
+
+        # builder -> its state file
+        states = {builder: args.state}
+        if args.toolchain:
+            states = dict()
+            for spec in args.toolchain:
+                name, compilers = spec.split("=", 1)
+                c_compiler, cxx_compiler = compilers.split(",")
+                filename = toolchain_filename(args.state, name)
+                if os.path.isfile(filename):
+                    toolchain = load_builder(filename)
+                    toolchain.set_compilers(c_compiler, cxx_compiler)
+                else:
+                    toolchain = builder.toolchain_builder(name, c_compiler, cxx_compiler)
+                states[toolchain] = filename
+        for toolchain in states:
+            if args.incremental:
+                toolchain.incremental = True
+            if args.scratch_dir is not None:
+                toolchain.scratch_dir = os.path.abspath(args.scratch_dir)
+            if args.sysroot is not None:
+                toolchain.sysroot = os.path.abspath(args.sysroot)
+                if toolchain.toolchain is not None:
+                    toolchain.sysroot = os.path.join(toolchain.sysroot, toolchain.toolchain)
+            if args.profile is not None:
+                toolchain.set_profile(parse_profile(args.profile))
+            if install_policies is not None:
+                toolchain.set_install_policies(install_policies)
+
+        if args.dry_run:
+            for toolchain in states:
+                if toolchain.toolchain is not None:
+                    print("{} ({}, {}):".format(toolchain.toolchain, toolchain.c_compiler, toolchain.cxx_compiler))
+                toolchain.print_plan(args.recipes, args.force)
+            return
+        try:
+            build_matrix(list(states), args.recipes, jobs=args.jobs, prefetch=not args.no_prefetch, force=args.force,
+                         on_done=lambda toolchain, label: save_builder(toolchain, states[toolchain]),
+                         memory_limit=parse_size(args.memory_limit) if args.memory_limit else None,
+                         on_failure=args.on_failure, timeouts=timeouts)
+        finally:
+            for toolchain, filename in states.items():
+                save_builder(toolchain, filename)
+                toolchain.write_lockfile(args.lockfile if toolchain.toolchain is None
+                                         else toolchain_filename(args.lockfile, toolchain.toolchain))
+            builder.timings = [event for toolchain in states for event in toolchain.timings]
+            if args.timings:
+                builder.write_timings(args.timings)
+            if args.trace:
+                builder.write_trace(args.trace)
+    elif args.command == "export":
+        if builder.artifact_dir is None:
+            raise RuntimeError("Artifact directory is not set, use BUILDER_ARTIFACT_DIR environment variable")
+        builder.export_artifacts(args.recipes or [label for label, recipe in RECIPES.items()
+                                                  if recipe.prefix in builder.prefixes])
+    elif args.command == "plan":
+        if args.compilers is not None:
+            builder.c_compiler, builder.cxx_compiler = args.compilers.split(",")
+        if args.profile is not None:
+            builder.profile = parse_profile(args.profile)
+        changes = builder.plan_changes(args.recipes, args.lockfile)
+        if args.names:
+            print(" ".join(label for label, reasons in changes))
+        elif not changes:
+            print("Nothing to rebuild")
+        else:
+            for label, reasons in changes:
+                print("{}: {}".format(label, "; ".join(reasons)))
+    elif args.command == "sysroot":
+        if args.directory is not None:
+            builder.sysroot = os.path.abspath(args.directory)
+        if builder.sysroot is None:
+            raise RuntimeError("Sysroot directory is not set, pass it or use BUILDER_SYSROOT environment variable")
+        for label in args.recipes or [label for label, recipe in RECIPES.items() if recipe.prefix in builder.prefixes]:
+            builder.stage(label)
+        save_builder(builder, args.state)
+
+
+if __name__ == "__main__":
+    main()
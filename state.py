@@ -0,0 +1,82 @@
+#!/bin/python
+
+import json
+import sqlite3
+import sys
+import time
+
+
+class StateStore:
+    """
+    Builder state stored in SQLite database.
+
+    Tables:
+    - settings: Builder attribute name -> JSON-encoded value;
+    - prefixes: library label -> installation prefix.
+
+    Every write is a separate transaction, so scripts running at the same time may
+    update different entries without losing each other's results. Readers are not
+    blocked by writers thanks to the write-ahead log. Only the standard library is
+    used, so the state can be inspected without importing builder.py.
+    """
+
+    def __init__(self, filename="builder.db", timeout=600):
+        self.connection = sqlite3.connect(filename, timeout=timeout, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.transaction():
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings "
+                                    "(name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS prefixes "
+                                    "(label TEXT PRIMARY KEY, prefix TEXT NOT NULL, updated REAL NOT NULL)")
+
+    def close(self):
+        self.connection.close()
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def get_settings(self):
+        rows = self.connection.execute("SELECT name, value FROM settings").fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+    def get_prefixes(self):
+        rows = self.connection.execute("SELECT label, prefix FROM prefixes").fetchall()
+        return dict(rows)
+
+    """Write the given settings and prefixes; with replace, remove all the other ones."""
+    def update(self, settings, prefixes, removed_prefixes=(), replace=False):
+        with self.transaction():
+            if replace:
+                self.connection.execute("DELETE FROM settings")
+                self.connection.execute("DELETE FROM prefixes")
+            self.connection.executemany("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)",
+                                        [(name, json.dumps(value)) for name, value in settings.items()])
+            self.connection.executemany("INSERT OR REPLACE INTO prefixes (label, prefix, updated) VALUES (?, ?, ?)",
+                                        [(label, prefix, time.time()) for label, prefix in prefixes.items()])
+            self.connection.executemany("DELETE FROM prefixes WHERE label = ?",
+                                        [(label,) for label in removed_prefixes])
+
+
+class Transaction:
+    """Exclusive write transaction: BEGIN IMMEDIATE takes the database write lock at once."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+def main():
+    store = StateStore(sys.argv[1] if len(sys.argv) > 1 else "builder.db")
+    print(json.dumps({"settings": store.get_settings(), "prefixes": store.get_prefixes()},
+                     indent=4, sort_keys=True))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()